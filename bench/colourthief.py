@@ -0,0 +1,114 @@
+'''
+Equivalence check and benchmark for SaturatedColourThief's pixel filter.
+
+Runs the pixel loop SaturatedColourThief.get_palette used before the
+lookup table, the byte loop and, if numpy is installed, the numpy filter
+over a fixed set of seeded synthetic logos. Every filter must keep the
+same pixels in the same order, and so give the same palette, before any
+timings are reported.
+
+Run from the repository root: python -m bench.colourthief
+'''
+import random
+import timeit
+
+from colorthief import MMCQ
+from PIL import Image
+
+from utils import colourthief
+from utils.colourthief import SaturatedColourThief, saturated_table
+
+QUALITIES = (1, 10)
+REPEAT = 3
+
+
+def noise(size: int, seed: int) -> Image.Image:
+    'Random RGBA pixels, about half of them transparent'
+    generator = random.Random(seed)
+    data = bytes(generator.getrandbits(8) for _ in range(4 * size * size))
+    return Image.frombytes('RGBA', (size, size), data)
+
+
+def gradient(size: int) -> Image.Image:
+    'Opaque red to blue gradient fading to black'
+    image = Image.new('RGBA', (size, size))
+    image.putdata([(255 * x // size, 0, 255 * y // size, 255)
+                   for y in range(size) for x in range(size)])
+    return image
+
+
+def greyscale(size: int) -> Image.Image:
+    'Opaque grey levels only, so nothing is saturated'
+    image = Image.new('RGBA', (size, size))
+    image.putdata([(level, level, level, 255)
+                   for level in (255 * i // (size * size)
+                                 for i in range(size * size))])
+    return image
+
+
+FIXTURES = {
+    'noise 64px': noise(64, 1),
+    'noise 512px': noise(512, 2),
+    'gradient 128px': gradient(128),
+    'greyscale 64px': greyscale(64),
+}
+
+
+def old_pixels(image: Image.Image, quality: int) -> list:
+    'The loop SaturatedColourThief.get_palette used before the table'
+    pixels = image.getdata()
+    pixel_count = image.size[0] * image.size[1]
+    valid_pixels = []
+    for i in range(0, pixel_count, quality):
+        if pixels[i][3] < 125:
+            continue
+        max_rgb = max(pixels[i][:3]) / 255.0
+        min_rgb = min(pixels[i][:3]) / 255.0
+        lightness = 0.5 * (max_rgb + min_rgb)
+        if lightness <= 0.1 or lightness > 0.9:
+            continue
+        if lightness <= 0.5:
+            saturation = (max_rgb - min_rgb) / (2 * lightness)
+        else:
+            saturation = (max_rgb - min_rgb) / (2 - 2 * lightness)
+        if saturation > 0.4:
+            valid_pixels.append(pixels[i][:3])
+    return valid_pixels
+
+
+def palette(pixels: list) -> list:
+    return MMCQ.quantize(pixels, 10).palette if pixels else []
+
+
+def main():
+    saturated_table()  # Built once per process, keep it out of timings
+    filters = {
+        'old loop': old_pixels,
+        'byte loop': SaturatedColourThief.saturated_pixels,
+    }
+    if colourthief.numpy is not None:
+        filters['numpy'] = SaturatedColourThief.saturated_pixels_numpy
+    else:
+        print('numpy is not installed, skipping the numpy filter')
+
+    for name, image in FIXTURES.items():
+        for quality in QUALITIES:
+            expected = old_pixels(image, quality)
+            expected_palette = palette(expected)
+            timings = []
+            for filter_name, pixel_filter in filters.items():
+                pixels = pixel_filter(image, quality)
+                assert pixels == expected, (name, quality, filter_name)
+                assert palette(pixels) == expected_palette
+                seconds = min(timeit.repeat(
+                    lambda: pixel_filter(image, quality),
+                    number=1, repeat=REPEAT))
+                timings.append('{} {:.1f}ms'.format(filter_name,
+                                                    1000 * seconds))
+            print('{:<16} quality {:<3} {:>7} pixels kept: {}'.format(
+                name, quality, len(expected), ', '.join(timings)))
+    print('All filters match the old loop')
+
+
+if __name__ == '__main__':
+    main()
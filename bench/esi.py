@@ -0,0 +1,140 @@
+'''
+Throughput of EsiCog.esi_request against a local stand-in ESI server.
+
+The stand-in answers every request after a fixed latency. The same batch
+of concurrent requests is sent through esi_request twice. The first run
+uses the aiohttp session on the event loop, as EsiCog does now. The second
+uses the requests session in the default thread pool that EsiCog used
+before. Every request is for a different URL, so none are answered from
+the cache or coalesced.
+
+Run from the repository root: python -m bench.esi [requests] [latency ms]
+'''
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+import requests
+from aiohttp import web
+from requests.adapters import DEFAULT_POOLSIZE
+
+from utils.esicache import EsiCache
+from utils.esicog import DEFAULT_POOL_SIZE, ESI_RETRIES, ESI_TIMEOUT, EsiCog
+from utils.esischeduler import PRIORITY_HIGH, EsiScheduler
+
+REQUESTS = 500
+LATENCY = 0.05
+BODY = b'{"name": "Stand-in", "published": true}'
+
+
+class StandInRequest:
+    'The parts of a pyswagger request used by esi_request'
+
+    def __init__(self, url: str):
+        self.method = 'GET'
+        self.url = url
+        self.query = []
+        self.data = None
+        self.header = {}
+
+    def prepare(self, scheme, handle_files):
+        pass
+
+
+class StandInResponse:
+    'The parts of a pyswagger response used by esi_request'
+
+    status = None
+
+    def apply_with(self, status, raw, header):
+        self.status = status
+
+
+class ExecutorEsiCog(EsiCog):
+    '''EsiCog sending requests as it did before, with requests in the
+    default thread pool'''
+
+    semaphore: asyncio.Semaphore = None
+    blocking_session: requests.Session = None
+
+    async def _send(self, method: str, url: str, params, data, headers: dict,
+                    priority: int = PRIORITY_HIGH) -> tuple:
+        async with self.semaphore:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self._send_blocking, method, url, params, data,
+                headers)
+
+    def _send_blocking(self, method: str, url: str, params, data,
+                       headers: dict) -> tuple:
+        for _ in range(ESI_RETRIES):
+            result = self.blocking_session.request(
+                method.upper(), url, params=params, data=data,
+                headers=headers, timeout=ESI_TIMEOUT)
+            if result.status_code < 500:
+                break
+        return result.status_code, dict(result.headers), result.content
+
+
+async def stand_in_esi(request):
+    await asyncio.sleep(LATENCY)
+    return web.Response(body=BODY, content_type='application/json')
+
+
+async def run(cog: EsiCog, base_url: str, count: int) -> float:
+    'Send count concurrent requests, returning how many per second finished'
+    start = time.monotonic()
+    responses = await asyncio.gather(*(
+        cog.esi_request((StandInRequest('{}{}/'.format(base_url, i)),
+                         StandInResponse())) for i in range(count)))
+    elapsed = time.monotonic() - start
+    assert all(response.status == 200 for response in responses)
+    return count / elapsed
+
+
+async def main(count: int):
+    loop = asyncio.get_event_loop()
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/{run}/types/{type_id}/', stand_in_esi)
+    handler = app.make_handler()
+    server = await loop.create_server(handler, '127.0.0.1', 0)
+    base_url = 'http://127.0.0.1:{}/{{}}/types/'.format(
+        server.sockets[0].getsockname()[1])
+
+    with tempfile.TemporaryDirectory() as directory:
+        EsiCog._cache = EsiCache(os.path.join(directory, 'cache.sqlite3'))
+        EsiCog._scheduler = EsiScheduler(DEFAULT_POOL_SIZE)
+        EsiCog._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=DEFAULT_POOL_SIZE,
+                                           loop=loop), loop=loop)
+        ExecutorEsiCog.semaphore = asyncio.Semaphore(DEFAULT_POOLSIZE)
+        ExecutorEsiCog.blocking_session = requests.Session()
+        # The cogs are not constructed, so no esipy App is loaded.
+        cogs = (('aiohttp on the loop', EsiCog.__new__(EsiCog), 'aiohttp'),
+                ('requests in executor',
+                 ExecutorEsiCog.__new__(ExecutorEsiCog), 'requests'))
+        try:
+            for name, cog, prefix in cogs:
+                rate = await run(cog, base_url.format(prefix), count)
+                print('{:<22} {:>8.1f} requests/s'.format(name, rate))
+        finally:
+            EsiCog._session.close()
+            ExecutorEsiCog.blocking_session.close()
+            EsiCog._cache.close()
+
+    server.close()
+    await server.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(1.0)
+    await app.cleanup()
+
+
+if __name__ == '__main__':
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+    if len(sys.argv) > 2:
+        LATENCY = float(sys.argv[2]) / 1000
+    print('{} requests, {:.0f}ms server latency'.format(COUNT,
+                                                       1000 * LATENCY))
+    asyncio.get_event_loop().run_until_complete(main(COUNT))
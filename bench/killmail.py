@@ -0,0 +1,148 @@
+'''
+Memory held by queued killmails as packages and as Killmail objects.
+
+A batch of synthetic RedisQ packages, each with 20 attackers and 30 items,
+is decoded twice under tracemalloc. First each package is kept with
+its fetched ESI data attached, as the poster carried them before Killmail.
+Then each is reduced to a Killmail and given the same data with set_data.
+The ESI data stands in for the universe and type records the fetch plan
+returns.
+
+Run from the repository root: python -m bench.killmail [killmails]
+'''
+import copy
+import json
+import sys
+import tracemalloc
+
+from ext.killmails.killmail import Killmail
+
+KILLMAILS = 1000
+SHIP_TYPE = {
+    'name': 'Rifter',
+    'type_id': 587,
+    'description': 'x' * 800,
+    'dogma_attributes': [{'attribute_id': attribute, 'value': float(attribute)}
+                         for attribute in range(1100, 1200)],
+    'dogma_effects': [{'effect_id': effect, 'is_default': False}
+                      for effect in range(40)],
+}
+
+
+def make_package(kill_id: int) -> dict:
+    attackers = [{
+        'character_id': 90000000 + i,
+        'corporation_id': 98000000 + i % 50,
+        'alliance_id': 99000000 + i % 5,
+        'ship_type_id': 587 + i % 30,
+        'weapon_type_id': 3000 + i,
+        'damage_done': 100 + i,
+        'final_blow': i == 0,
+        'security_status': -1.5,
+    } for i in range(20)]
+    items = [{
+        'flag': flag,
+        'item_type_id': 1000 + flag,
+        'quantity_destroyed': 1,
+        'singleton': 0,
+    } for flag in list(range(11, 35)) + [92, 93, 94, 5, 5, 5]]
+    return {
+        'killID': kill_id,
+        'killmail': {
+            'killmail_id': kill_id,
+            'killmail_time': '2018-05-01T12:00:00Z',
+            'solar_system_id': 30000142,
+            'attackers': attackers,
+            'victim': {
+                'character_id': 1,
+                'corporation_id': 2,
+                'alliance_id': 3,
+                'ship_type_id': 587,
+                'damage_taken': 5000,
+                'position': {'x': 1.0, 'y': 2.0, 'z': 3.0},
+                'items': items,
+            },
+        },
+        'zkb': {
+            'locationID': 1,
+            'hash': '0123456789abcdef' * 2,
+            'fittedValue': 1e7,
+            'totalValue': 2e7,
+            'points': 10,
+            'npc': False,
+            'solo': False,
+            'awox': False,
+        },
+    }
+
+
+def make_data() -> dict:
+    'Fetched ESI data as the fetch plan returns it'
+    return {
+        'solar_system': {
+            'name': 'Jita',
+            'system_id': 30000142,
+            'constellation_id': 20000020,
+            'security_status': 0.9,
+            'star_id': 1,
+            'planets': [{'planet_id': planet} for planet in range(8)],
+            'position': {'x': 1.0, 'y': 2.0, 'z': 3.0},
+        },
+        'constellation': {
+            'name': 'Kimotoro',
+            'constellation_id': 20000020,
+            'region_id': 10000002,
+            'systems': list(range(8)),
+            'position': {'x': 1.0, 'y': 2.0, 'z': 3.0},
+        },
+        'region': {
+            'name': 'The Forge',
+            'region_id': 10000002,
+            'description': 'y' * 300,
+            'constellations': list(range(10)),
+        },
+        'ship_type': copy.deepcopy(SHIP_TYPE),
+        'character': {'name': 'Bob'},
+        'affiliation': {'name': 'Corp'},
+    }
+
+
+def traced(function, raws: list) -> float:
+    'MB still allocated after function has built a list from raws'
+    tracemalloc.start()
+    kept = function(raws)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return allocated / 1e6
+
+
+def as_packages(raws: list) -> list:
+    packages = []
+    for raw in raws:
+        package = json.loads(raw)
+        package['data'] = make_data()
+        packages.append(package)
+    return packages
+
+
+def as_killmails(raws: list) -> list:
+    killmails = []
+    for raw in raws:
+        killmail = Killmail(json.loads(raw))
+        killmail.set_data(make_data())
+        killmails.append(killmail)
+    return killmails
+
+
+def main(count: int):
+    raws = [json.dumps(make_package(70000000 + i)) for i in range(count)]
+    packages = traced(as_packages, raws)
+    killmails = traced(as_killmails, raws)
+    print('{} killmails, 20 attackers and 30 items each'.format(count))
+    print('As packages with data: {:6.1f} MB'.format(packages))
+    print('As Killmails:          {:6.1f} MB'.format(killmails))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else KILLMAILS)
@@ -0,0 +1,99 @@
+'''
+CPU time saved by KillmailPrefilter on a recorded RedisQ archive.
+
+Every response of an archive made with "redisq record" is decoded with
+json.loads, as the listener did before the prefilter. Then the same
+responses are run through KillmailPrefilter.matches, and only the ones it
+keeps are decoded. Relevancies and routes are read from the bot's TinyDB
+file, as the poster would route them. Alliance members are not fetched,
+so only corporations tracked directly and alliances match.
+
+Run from the repository root:
+python -m bench.prefilter <archive> [db.json]
+'''
+import json
+import logging
+import sys
+import time
+
+from tinydb import TinyDB
+
+from ext.killmails.prefilter import KillmailPrefilter
+from ext.killmails.relevancy import RelevancyIndex
+from ext.killmails.replay import read_archive
+from ext.killmails.routing import RoutingTable
+from utils.kvtable import KeyValueTable
+
+ROUNDS = 5
+
+
+def routing_table(database: TinyDB) -> RoutingTable:
+    'A ready RoutingTable of the bot\'s relevancies, routes and channel'
+    logger = logging.getLogger(__name__)
+    index = RelevancyIndex(database.table('killmails.relevancies'), None,
+                           logger)
+    index.sync()
+    index.ready.set()
+    config = KeyValueTable(database, 'killmails.config')
+    channel = config.get('channel', 'default')
+    default_routes = [{'channel': channel}]
+    if config.get('others_value'):
+        default_routes.append({'channel': channel, 'open': True,
+                               'min_value': config['others_value'] * 1000000})
+    return RoutingTable(database.table('killmails.routes'), index,
+                        default_routes, logger)
+
+
+def decode_all(responses: list) -> int:
+    for raw in responses:
+        json.loads(raw.decode('utf-8'))
+    return len(responses)
+
+
+def decode_matching(responses: list, prefilter: KillmailPrefilter,
+                    routing: RoutingTable) -> int:
+    decoded = 0
+    for raw in responses:
+        if prefilter.matches(raw, routing):
+            json.loads(raw.decode('utf-8'))
+            decoded += 1
+    return decoded
+
+
+def cpu_time(function, *args) -> tuple:
+    'The lowest process time of ROUNDS calls, and the last result'
+    best = None
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        result = function(*args)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(path: str, database_path: str):
+    responses = [raw for _, raw in read_archive(path)]
+    size = sum(map(len, responses))
+    database = TinyDB(database_path)
+    routing = routing_table(database)
+    prefilter = KillmailPrefilter()
+    prefilter.matches(b'{}', routing)  # Compile the routes beforehand
+
+    baseline, _ = cpu_time(decode_all, responses)
+    filtered, decoded = cpu_time(decode_matching, responses, prefilter,
+                                 routing)
+    database.close()
+
+    print('{} responses ({:.1f} MiB), {} decoded after the prefilter'.format(
+        len(responses), size / 2**20, decoded))
+    print('json.loads of every response: {:8.1f}ms'.format(1000 * baseline))
+    print('prefilter then json.loads:    {:8.1f}ms'.format(1000 * filtered))
+    if baseline:
+        print('CPU time saved: {:.1f}%'.format(
+            100 * (baseline - filtered) / baseline))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'db.json')
@@ -0,0 +1,103 @@
+'''
+Cost of RoutingTable.match against the number of routes.
+
+Seeded synthetic routes and killmails are generated for 1, 10, 100 and
+1000 routes. Each route follows a few corporations and alliances taken
+from a fixed pool, and one route in ten is open. The mean time to route
+one killmail is reported for each table size.
+
+Run from the repository root: python -m bench.routing
+'''
+import logging
+import random
+import timeit
+
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+from ext.killmails.killmail import Killmail
+from ext.killmails.relevancy import RelevancyIndex
+from ext.killmails.routing import DIRECTIONS, RoutingTable
+
+ROUTE_COUNTS = (1, 10, 100, 1000)
+KILLMAILS = 2000
+CORPORATIONS = range(98000000, 98005000)
+ALLIANCES = range(99000000, 99000500)
+ROUNDS = 5
+
+
+def make_route(generator: random.Random, number: int) -> dict:
+    route = {
+        'channel': str(number % 50),
+        'direction': generator.choice(DIRECTIONS),
+        'min_value': generator.choice((0, 10000000, 1000000000)),
+    }
+    if number % 10 == 9:
+        route['open'] = True
+    else:
+        route['corporations'] = generator.sample(CORPORATIONS, 3)
+        route['alliances'] = generator.sample(ALLIANCES, 2)
+    return route
+
+
+def make_killmail(generator: random.Random, kill_id: int) -> Killmail:
+    attackers = [{
+        'corporation_id': generator.choice(CORPORATIONS),
+        'alliance_id': generator.choice(ALLIANCES),
+        'ship_type_id': 587,
+    } for _ in range(int(generator.expovariate(0.1)) + 1)]
+    return Killmail({
+        'killID': kill_id,
+        'killmail': {
+            'killmail_time': '2018-01-01T00:00:00Z',
+            'solar_system_id': 30000142,
+            'victim': {
+                'ship_type_id': 587,
+                'corporation_id': generator.choice(CORPORATIONS),
+                'alliance_id': generator.choice(ALLIANCES),
+            },
+            'attackers': attackers,
+        },
+        'zkb': {'totalValue': generator.expovariate(1 / 100000000)},
+    })
+
+
+def routing_table(routes: list) -> RoutingTable:
+    'A ready RoutingTable of the given routes over an empty index'
+    logger = logging.getLogger(__name__)
+    database = TinyDB(storage=MemoryStorage)
+    table = database.table('killmails.routes')
+    table.insert_multiple(routes)
+    index = RelevancyIndex(database.table('killmails.relevancies'), None,
+                           logger)
+    index.sync()
+    index.ready.set()
+    routing = RoutingTable(table, index, [], logger)
+    routing.compile()
+    return routing
+
+
+def main():
+    generator = random.Random(1)
+    killmails = [make_killmail(generator, i) for i in range(KILLMAILS)]
+    mean_attackers = sum(len(killmail.attacker_corporations)
+                         for killmail in killmails) / KILLMAILS
+    print('{} killmails, {:.1f} attackers on average'.format(
+        KILLMAILS, mean_attackers))
+
+    for count in ROUTE_COUNTS:
+        routing = routing_table(
+            [make_route(generator, number) for number in range(count)])
+
+        def route_all():
+            for killmail in killmails:
+                routing.match(killmail)
+
+        seconds = min(timeit.repeat(route_all, number=1, repeat=ROUNDS))
+        matched = sum(1 for killmail in killmails if routing.match(killmail))
+        print('{:>5} routes: {:>7.2f}us per killmail, {} routed'.format(
+            count, 1000000 * seconds / KILLMAILS, matched))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 Set up core extensions
 """
 from .control import Control
+from .outbound import Outbound
 
 
 def setup(bot):
@@ -9,3 +10,4 @@ def setup(bot):
 
     """
     bot.add_cog(Control(bot))
+    bot.add_cog(Outbound(bot))
@@ -0,0 +1,195 @@
+'''
+Outbound Discord message scheduler made for antinub-gregbot project.
+
+Messages and reactions are queued per rate limit route (a channel's
+messages or its reactions) and sent in order of priority, so that pings
+are not stuck behind a burst of killmails. Each route tracks its own
+bucket and waits for it to refill instead of running into 429 responses.
+'''
+import asyncio
+import heapq
+import itertools
+import time
+import typing
+from collections import deque
+
+import discord
+from discord.ext import commands
+
+from utils.log import get_logger
+
+PRIORITY_PING = 0
+PRIORITY_KILLMAIL = 1
+
+MESSAGE_BUCKET = (5, 5.0)  # 5 messages per 5 seconds per channel
+REACTION_BUCKET = (1, 0.25)  # 1 reaction per 0.25 seconds per channel
+WAIT_SAMPLES = 100
+
+
+def setup(bot):
+    'Adds the cog to the provided discord bot'
+    bot.add_cog(Outbound(bot))
+
+
+class Route:
+    '''A queue of calls sharing one rate limit bucket, sent one at a time
+    highest priority first'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, name: str,
+                 limit: int, period: float):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.remaining = limit
+        self.reset = 0.0
+
+        self.waiting: typing.List[tuple] = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event(loop=loop)
+        self.task = loop.create_task(self.work())
+
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    def put(self, call: typing.Callable, priority: int) -> asyncio.Future:
+        'Queue a coroutine function, returning a future of its result'
+        future = asyncio.Future()
+        heapq.heappush(self.waiting, (priority, next(self.counter),
+                                      time.monotonic(), call, future))
+        self.wakeup.set()
+        return future
+
+    def delay(self) -> float:
+        'Seconds until the bucket allows another call'
+        now = time.monotonic()
+        if now >= self.reset:
+            self.remaining = self.limit
+            self.reset = now + self.period
+        if self.remaining > 0:
+            return 0
+        return self.reset - now
+
+    async def work(self):
+        while True:
+            if not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            delay = self.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, queued, call, future = heapq.heappop(self.waiting)
+            if future.done():  # Cancelled by the caller
+                continue
+            self.remaining -= 1
+            self.waits.append(time.monotonic() - queued)
+            try:
+                result = await call()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except discord.HTTPException as exception:
+                if exception.response.status == 429:
+                    # Our idea of the bucket was wrong, wait for a full reset
+                    self.rate_limited += 1
+                    self.remaining = 0
+                    self.reset = time.monotonic() + self.period
+                self.failed += 1
+                self.resolve(future, exception=exception)
+            except Exception as exception:
+                self.failed += 1
+                self.resolve(future, exception=exception)
+            else:
+                self.sent += 1
+                self.resolve(future, result)
+
+    @staticmethod
+    def resolve(future: asyncio.Future, result=None, exception=None):
+        '''Settle a caller's future unless the caller has given up on it
+        while its call was in flight'''
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def close(self):
+        self.task.cancel()
+        for _, _, _, _, future in self.waiting:
+            future.cancel()
+
+    def get_health(self) -> str:
+        'Returns a string describing the queue of this route'
+        mean_wait = sum(self.waits) / len(self.waits) if self.waits else 0
+        return ('\n  \u2714 {}: {} queued, {} sent, {} failed, {} rate '
+                'limited, mean wait {:.0f}ms').format(
+                    self.name, len(self.waiting), self.sent, self.failed,
+                    self.rate_limited, 1000 * mean_wait)
+
+
+class Outbound:
+    '''A cog which sends messages and reactions for other cogs, keeping
+    within Discord's per channel rate limits'''
+
+    def __init__(self, bot: commands.Bot):
+        self.logger = get_logger(__name__, bot)
+        self.bot = bot
+        self.routes: typing.Dict[tuple, Route] = {}
+
+    def __unload(self):
+        for route in self.routes.values():
+            route.close()
+
+    def get_route(self, kind: str, channel,
+                  bucket: typing.Tuple[int, float]) -> Route:
+        key = (kind, channel.id)
+        if key not in self.routes:
+            name = '#{} {}'.format(getattr(channel, 'name', None) or
+                                   channel.id, kind)
+            self.routes[key] = Route(self.bot.loop, name, *bucket)
+        return self.routes[key]
+
+    async def send_message(self, channel, content: str = None, *,
+                           embed: discord.Embed = None,
+                           priority: int = PRIORITY_KILLMAIL
+                           ) -> discord.Message:
+        'Queue a message, returning it once it has been sent'
+        route = self.get_route('messages', channel, MESSAGE_BUCKET)
+        return await route.put(
+            lambda: self.bot.send_message(channel, content, embed=embed),
+            priority)
+
+    def add_reactions(self, message: discord.Message,
+                      emojis: typing.Iterable,
+                      priority: int = PRIORITY_KILLMAIL) -> asyncio.Future:
+        '''Queue reactions to a message without waiting for them to be
+        added, returning a future of them all'''
+        route = self.get_route('reactions', message.channel, REACTION_BUCKET)
+        futures = [
+            route.put(
+                lambda emoji=emoji: self.bot.add_reaction(message, emoji),
+                priority) for emoji in emojis
+        ]
+        future = asyncio.gather(*futures, return_exceptions=True)
+        future.add_done_callback(self.log_failures)
+        return future
+
+    def log_failures(self, future: asyncio.Future):
+        if future.cancelled():
+            return
+        for result in future.result():
+            if isinstance(result, Exception):
+                self.logger.warning('Failed to add reaction: %s', result)
+
+    def get_health(self) -> str:
+        'Returns a string describing the outbound queue of every channel'
+        if not self.routes:
+            return '\n  \u2714 Nothing sent yet'
+        return ''.join(route.get_health()
+                       for _, route in sorted(self.routes.items()))
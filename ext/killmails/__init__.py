@@ -1,3 +1,3 @@
 from utils import extension
 
-extension.configure(["listener", "poster"])
+extension.configure(["listener", "poster", "stats"])
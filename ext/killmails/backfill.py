@@ -0,0 +1,177 @@
+'''
+Backfilling of killmails missed while the bot was down or RedisQ was
+unreachable.
+
+The kills of every tracked corporation and alliance since the last
+processed killmail are fetched from zKillboard's API and ESI, then posted
+in chronological order through the poster like any live killmail.
+'''
+import asyncio
+import json
+import math
+import time
+import typing
+
+import aiohttp
+
+from utils.esischeduler import PRIORITY_BACKGROUND
+
+from .killmail import Killmail
+
+ZKILLBOARD_API_URL = "https://zkillboard.com/api"
+USER_AGENT = "antinub-gregbot"
+BACKFILL_THRESHOLD = 300
+MAXIMUM_PAST_SECONDS = 7 * 24 * 3600
+SAVE_INTERVAL = 60
+CONCURRENCY = 5
+PAGE_SIZE = 200  # zKillboard returns at most this many kills per page
+MAXIMUM_PAGES = 10
+TIMEOUT = 60
+
+
+class Backfill:
+    '''Tracks the last processed killmail and fetches any missed since'''
+
+    def __init__(self, poster):
+        self.poster = poster
+        # Slow zKillboard responses should not hold connections Discord
+        # requests need, so backfills have a session of their own.
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=CONCURRENCY,
+                                           loop=poster.bot.loop),
+            loop=poster.bot.loop)
+        self.logger = poster.logger
+        self.api_url = poster.config_table.get("zkillboard_api_url",
+                                               ZKILLBOARD_API_URL)
+        self.semaphore = asyncio.Semaphore(CONCURRENCY)
+
+        self.last_kill_time: float = poster.config_table.get(
+            "last_kill_time")
+        self.last_saved = time.monotonic()
+        self.task: asyncio.Task = None
+        self.runs = 0
+        self.found = 0
+        self.posted = 0
+
+    def observe(self, killmail: Killmail):
+        'Record the time of a processed killmail, saving it periodically'
+        if self.last_kill_time is None or killmail.time > self.last_kill_time:
+            self.last_kill_time = killmail.time
+        if time.monotonic() - self.last_saved > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        if self.last_kill_time is not None:
+            self.poster.config_table["last_kill_time"] = self.last_kill_time
+        self.last_saved = time.monotonic()
+
+    def close(self):
+        self.save()
+        if self.task is not None:
+            self.task.cancel()
+        self.session.close()
+
+    def schedule(self, since: float):
+        'Start backfilling from since unless a backfill is already running'
+        if since is None or time.time() - since < BACKFILL_THRESHOLD:
+            return
+        if self.task is not None and not self.task.done():
+            return
+        self.task = self.poster.bot.loop.create_task(self.run(since))
+
+    async def run(self, since: float):
+        'Fetch and post every relevant killmail since the given time'
+        index = self.poster.relevancy_index
+        await index.ready.wait()
+        past_seconds = min(MAXIMUM_PAST_SECONDS,
+                           3600 * math.ceil((time.time() - since) / 3600))
+        self.logger.info("Backfilling killmails from the last %d hours",
+                         past_seconds // 3600)
+        self.runs += 1
+
+        entities = [("corporationID", entity_id)
+                    for entity_id in index.corporations]
+        entities += [("allianceID", entity_id)
+                     for entity_id in index.alliances]
+        results = await asyncio.gather(
+            *(self.fetch_entity(entity_type, entity_id, past_seconds)
+              for entity_type, entity_id in entities),
+            return_exceptions=True)
+
+        summaries = {}
+        for (entity_type, entity_id), result in zip(entities, results):
+            if isinstance(result, Exception):
+                self.logger.warning("Failed to backfill %s %s: %s",
+                                    entity_type, entity_id, result)
+                continue
+            for summary in result:
+                if summary["killmail_id"] not in self.poster.seen:
+                    summaries[summary["killmail_id"]] = summary
+
+        killmails = await asyncio.gather(
+            *map(self.fetch_killmail, summaries.values()),
+            return_exceptions=True)
+        killmails = [
+            killmail for killmail in killmails
+            if not isinstance(killmail, Exception)
+        ]
+        self.found += len(killmails)
+        killmails.sort(key=lambda killmail: killmail.time)
+
+        for killmail in killmails:
+            try:
+                if await self.poster.process_killmail(killmail):
+                    self.posted += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await self.poster.on_killmail_error(killmail)
+
+    async def fetch_entity(self, entity_type: str, entity_id: int,
+                           past_seconds: int) -> typing.List[dict]:
+        '''Return the zKillboard summaries of an entity\'s recent kills,
+        following pages until one comes back short'''
+        summaries = []
+        for page in range(1, MAXIMUM_PAGES + 1):
+            url = "{}/{}/{}/pastSeconds/{}/page/{}/".format(
+                self.api_url, entity_type, entity_id, past_seconds, page)
+            async with self.semaphore:
+                with aiohttp.Timeout(TIMEOUT):
+                    async with self.session.get(
+                            url, headers={"User-Agent": USER_AGENT}) as resp:
+                        resp.raise_for_status()
+                        results = json.loads(
+                            (await resp.read()).decode("utf-8"))
+            summaries += results
+            if len(results) < PAGE_SIZE:
+                return summaries
+        self.logger.warning(
+            "Backfill of %s %s stopped after %d pages, older kills are "
+            "missed", entity_type, entity_id, MAXIMUM_PAGES)
+        return summaries
+
+    async def fetch_killmail(self, summary: dict) -> Killmail:
+        'Return the Killmail for a zKillboard summary'
+        esi_app = await self.poster.get_esi_app()
+        operation = esi_app.op["get_killmails_killmail_id_killmail_hash"](
+            killmail_id=summary["killmail_id"],
+            killmail_hash=summary["zkb"]["hash"])
+        async with self.semaphore:
+            response = await self.poster.esi_request(operation,
+                                                     PRIORITY_BACKGROUND)
+        if response.status != 200:
+            self.logger.warning("Failed to fetch killmail %s: %s",
+                                summary["killmail_id"], response.status)
+            raise LookupError(summary["killmail_id"])
+        return Killmail({
+            "killID": summary["killmail_id"],
+            "killmail": json.loads(response.raw.decode("utf-8")),
+            "zkb": summary["zkb"],
+        })
+
+    def get_health(self) -> str:
+        'Returns a string describing past backfills'
+        running = self.task is not None and not self.task.done()
+        return ('\n  \u2714 Backfill: {}, {} runs, {} missed killmails found, '
+                '{} posted').format('running' if running else 'idle',
+                                    self.runs, self.found, self.posted)
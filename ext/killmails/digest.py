@@ -0,0 +1,103 @@
+'''
+Digest mode for floods of relevant killmails.
+
+When kills arrive faster than a channel can carry them, or the queue backs
+up, they are collected and posted once a minute as a single summary
+instead of one embed each. Individual posts resume once the rate drops.
+'''
+import asyncio
+import time
+import typing
+from collections import deque
+
+from .killmail import Killmail
+
+DIGEST_RATE = 10  # Relevant kills per minute which start digest mode
+CALM_RATE = 4  # Relevant kills per minute below which it ends
+DIGEST_BACKLOG = 20  # Queued killmails which start digest mode
+DIGEST_INTERVAL = 60
+RATE_WINDOW = 60
+
+
+class KillmailDigest:
+    '''Decides when to digest killmails and periodically posts the
+    collected kills through post'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, post: typing.Callable,
+                 backlog: typing.Callable, logger, rate: int = DIGEST_RATE,
+                 max_backlog: int = DIGEST_BACKLOG,
+                 interval: float = DIGEST_INTERVAL):
+        self.post = post
+        self.backlog = backlog
+        self.logger = logger
+        self.rate = rate
+        self.calm_rate = min(CALM_RATE, rate)
+        self.max_backlog = max_backlog
+        self.interval = interval
+
+        self.active = False
+        self.arrivals = deque()
+        self.killmails: typing.List[Killmail] = []
+        self.task = loop.create_task(self.run())
+
+        self.activations = 0
+        self.digests = 0
+        self.digested = 0
+
+    def close(self):
+        'Stop flushing, posting anything still collected'
+        self.task.cancel()
+        if self.killmails:
+            asyncio.ensure_future(self.flush())
+
+    def current_rate(self) -> int:
+        'Relevant kills which arrived within the last RATE_WINDOW seconds'
+        cutoff = time.monotonic() - RATE_WINDOW
+        while self.arrivals and self.arrivals[0] < cutoff:
+            self.arrivals.popleft()
+        return len(self.arrivals) * 60 // RATE_WINDOW
+
+    def observe(self) -> bool:
+        'Record the arrival of a relevant kill, returning whether to digest'
+        self.arrivals.append(time.monotonic())
+        if not self.active and (self.current_rate() >= self.rate or
+                                self.backlog() >= self.max_backlog):
+            self.active = True
+            self.activations += 1
+            self.logger.info("Killmail flood, posting digests")
+        return self.active
+
+    def add(self, killmail: Killmail):
+        self.killmails.append(killmail)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+            if (self.active and self.current_rate() <= self.calm_rate and
+                    self.backlog() < self.max_backlog):
+                self.active = False
+                self.logger.info("Killmail flood over, posting killmails")
+
+    async def flush(self):
+        'Post everything collected so far as one digest'
+        killmails, self.killmails = self.killmails, []
+        if not killmails:
+            return
+        self.digests += 1
+        self.digested += len(killmails)
+        try:
+            await self.post(killmails)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception("Failed to post digest of %d killmails",
+                                  len(killmails))
+
+    def get_health(self) -> str:
+        'Returns a string describing the digest mode'
+        return ('\n  \u2714 Digest: {}, {} kills/min, {} floods, {} digests '
+                'of {} killmails').format(
+                    'active' if self.active else 'inactive',
+                    self.current_rate(), self.activations, self.digests,
+                    self.digested)
@@ -0,0 +1,94 @@
+'''
+Declarative description of the ESI lookups needed to post a killmail.
+
+Each stage lists the stages whose results it needs, everything else is
+requested concurrently.
+'''
+import asyncio
+import time
+import typing
+from collections import defaultdict, deque, namedtuple
+
+TIMING_SAMPLES = 100
+
+FetchStage = namedtuple("FetchStage",
+                        ["name", "requires", "operation", "lookup", "name_id"])
+FetchStage.__new__.__defaults__ = (None, None)
+FetchStage.__doc__ = '''A single ESI lookup.
+
+operation is called with the esipy operations, the killmail and the data
+fetched so far, and returns the operation to request or None to skip it.
+If given, lookup is first called with the static data index, the killmail
+and the data so far, and its result is used instead of ESI unless None.
+If given, name_id is called with the killmail and returns the ID of an
+entity of which only the name is needed, which is resolved in bulk.'''
+
+
+class FetchPlan:
+    '''Runs a sequence of FetchStages, each as soon as its requirements are
+    met, and keeps recent timings for every stage'''
+
+    def __init__(self, stages: typing.Sequence[FetchStage], static_data=None,
+                 name_resolver=None):
+        self.stages = stages
+        self.static_data = static_data
+        self.name_resolver = name_resolver
+        self.static_hits = 0
+        self.timings: typing.Dict[str, deque] = defaultdict(
+            lambda: deque(maxlen=TIMING_SAMPLES))
+
+    async def run(self, esi_app, esi_request: typing.Callable,
+                  killmail) -> dict:
+        'Fetch the data for killmail, returning it keyed by stage name'
+        data = {}
+        tasks = {}
+
+        async def run_stage(stage: FetchStage):
+            for name in stage.requires:
+                await tasks[name]
+            if stage.lookup and self.static_data is not None:
+                result = stage.lookup(self.static_data, killmail, data)
+                if result is not None:
+                    self.static_hits += 1
+                    data[stage.name] = result
+                    return
+            if stage.name_id and self.name_resolver is not None:
+                entity_id = stage.name_id(killmail)
+                if entity_id is None:
+                    return
+                start = time.monotonic()
+                name = await self.name_resolver.resolve(entity_id)
+                if name is not None:
+                    self.timings[stage.name].append(time.monotonic() - start)
+                    data[stage.name] = {"name": name}
+                    return
+            operation = stage.operation(esi_app.op, killmail, data)
+            if operation is None:
+                return
+            start = time.monotonic()
+            response = await esi_request(operation)
+            self.timings[stage.name].append(time.monotonic() - start)
+            data[stage.name] = response.data
+
+        start = time.monotonic()
+        for stage in self.stages:
+            tasks[stage.name] = asyncio.ensure_future(run_stage(stage))
+        try:
+            await asyncio.gather(*tasks.values())
+        except Exception:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        self.timings["total"].append(time.monotonic() - start)
+
+        return data
+
+    def get_health(self) -> str:
+        'Returns a string with the mean duration of each stage'
+        if not self.timings:
+            return '\n  \u2714 No killmails fetched yet'
+        stages = ', '.join(
+            '{} {:.0f}ms'.format(name, 1000 * sum(samples) / len(samples))
+            for name, samples in self.timings.items())
+        return '\n  \u2714 Fetch timings: {} ({} static data lookups)'.format(
+            stages, self.static_hits)
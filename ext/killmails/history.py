@@ -0,0 +1,149 @@
+'''
+Local history of processed killmails.
+
+Every killmail the poster fetches is stored in SQLite, indexed by time,
+corporation, alliance, solar system and ship type, so that statistics can
+be answered without asking zKillboard.
+'''
+import sqlite3
+import threading
+import typing
+from collections import namedtuple
+
+from .killmail import Killmail
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS kills ('
+    'killmail_id INTEGER PRIMARY KEY, time INTEGER NOT NULL, '
+    'solar_system_id INTEGER, region_id INTEGER, ship_type_id INTEGER, '
+    'corporation_id INTEGER, alliance_id INTEGER, value REAL)',
+    'CREATE TABLE IF NOT EXISTS attackers ('
+    'killmail_id INTEGER NOT NULL, time INTEGER NOT NULL, '
+    'corporation_id INTEGER, alliance_id INTEGER, ship_type_id INTEGER)',
+    'CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT)',
+    'CREATE INDEX IF NOT EXISTS kills_time ON kills (time)',
+    'CREATE INDEX IF NOT EXISTS kills_corporation '
+    'ON kills (corporation_id, time)',
+    'CREATE INDEX IF NOT EXISTS kills_alliance ON kills (alliance_id, time)',
+    'CREATE INDEX IF NOT EXISTS kills_system '
+    'ON kills (solar_system_id, time)',
+    'CREATE INDEX IF NOT EXISTS kills_ship_type '
+    'ON kills (ship_type_id, time)',
+    'CREATE INDEX IF NOT EXISTS attackers_corporation '
+    'ON attackers (corporation_id, time)',
+    'CREATE INDEX IF NOT EXISTS attackers_alliance '
+    'ON attackers (alliance_id, time)',
+    'CREATE INDEX IF NOT EXISTS attackers_killmail ON attackers (killmail_id)',
+)
+
+Summary = namedtuple('Summary', ['kills', 'destroyed', 'losses', 'lost'])
+SystemSummary = namedtuple('SystemSummary',
+                           ['name', 'kills', 'losses', 'value'])
+
+
+def entity_filters(corporations: typing.Iterable[int],
+                   alliances: typing.Iterable[int]) -> typing.Tuple[str, str]:
+    '''Conditions matching rows of the given entities and rows of anyone
+    else. IDs are inlined, which avoids the bound parameter limit'''
+    corporations = ','.join(map(str, map(int, corporations))) or '-1'
+    alliances = ','.join(map(str, map(int, alliances))) or '-1'
+    ours = '(corporation_id IN ({}) OR alliance_id IN ({}))'.format(
+        corporations, alliances)
+    theirs = ('(IFNULL(corporation_id, 0) NOT IN ({}) AND '
+              'IFNULL(alliance_id, 0) NOT IN ({}))').format(
+                  corporations, alliances)
+    return ours, theirs
+
+
+class KillmailHistory:
+    '''SQLite store of killmails, with queries for a set of corporations and
+    alliances over a time window'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.database = sqlite3.connect(path)
+        self.database.execute('PRAGMA journal_mode=WAL')
+        self.database.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.database.execute(statement)
+        self.database.commit()
+        # Statistics are read on executor threads through their own
+        # connection so they never wait on or block the writer. Queries on
+        # it may come from several threads at once, so they take turns.
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader_lock = threading.Lock()
+        self.stored = 0
+
+    def close(self):
+        self.database.close()
+        with self.reader_lock:
+            self.reader.close()
+
+    def add(self, killmail: Killmail):
+        'Store a killmail and the names fetched for it'
+        with self.database:
+            cursor = self.database.execute(
+                'INSERT OR IGNORE INTO kills VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (killmail.kill_id, killmail.time, killmail.solar_system_id,
+                 killmail.region_id, killmail.victim_ship_type_id,
+                 killmail.victim_corporation_id, killmail.victim_alliance_id,
+                 killmail.value))
+            if not cursor.rowcount:
+                return
+            self.database.executemany(
+                'INSERT INTO attackers VALUES (?, ?, ?, ?, ?)',
+                ((killmail.kill_id, killmail.time, corporation_id or None,
+                  alliance_id or None, ship_type_id or None)
+                 for corporation_id, alliance_id, ship_type_id in zip(
+                     killmail.attacker_corporations,
+                     killmail.attacker_alliances,
+                     killmail.attacker_ship_types)
+                 if corporation_id or alliance_id))
+            self.database.executemany(
+                'INSERT OR REPLACE INTO names VALUES (?, ?)',
+                ((killmail.solar_system_id, killmail.names['solar_system']),
+                 (killmail.victim_ship_type_id,
+                  killmail.names['ship_type'])))
+        self.stored += 1
+
+    def summary(self, since: float, corporations: typing.Iterable[int],
+                alliances: typing.Iterable[int]) -> Summary:
+        'Kills and losses of the given entities since a time'
+        ours, theirs = entity_filters(corporations, alliances)
+        with self.reader_lock:
+            kills, destroyed = self.reader.execute(
+                'SELECT COUNT(*), TOTAL(value) FROM kills WHERE killmail_id '
+                'IN (SELECT killmail_id FROM attackers WHERE time >= :since '
+                'AND {0}) AND {1}'.format(ours, theirs),
+                {'since': since}).fetchone()
+            losses, lost = self.reader.execute(
+                'SELECT COUNT(*), TOTAL(value) FROM kills '
+                'WHERE time >= :since AND {}'.format(ours),
+                {'since': since}).fetchone()
+        return Summary(kills, destroyed, losses, lost)
+
+    def top_systems(self, since: float, corporations: typing.Iterable[int],
+                    alliances: typing.Iterable[int],
+                    limit: int = 10) -> typing.List[SystemSummary]:
+        'The systems with the most kills and losses of the given entities'
+        ours, theirs = entity_filters(corporations, alliances)
+        with self.reader_lock:
+            rows = self.reader.execute(
+                'SELECT IFNULL(name, involved.solar_system_id), '
+                'SUM(NOT lost), SUM(lost), TOTAL(value) FROM ('
+                'SELECT solar_system_id, value, 1 AS lost FROM kills '
+                'WHERE time >= :since AND {0} UNION ALL '
+                'SELECT solar_system_id, value, 0 FROM kills '
+                'WHERE killmail_id IN (SELECT killmail_id FROM attackers '
+                'WHERE time >= :since AND {0}) AND {1}) AS involved '
+                'LEFT JOIN names ON names.id = involved.solar_system_id '
+                'GROUP BY involved.solar_system_id '
+                'ORDER BY COUNT(*) DESC, TOTAL(value) DESC '
+                'LIMIT :limit'.format(ours, theirs),
+                {'since': since, 'limit': limit}).fetchall()
+        return [SystemSummary(*row) for row in rows]
+
+    def get_health(self) -> str:
+        'Returns a string describing the history store'
+        return '\n  \u2714 History: {} killmails stored this session'.format(
+            self.stored)
@@ -0,0 +1,98 @@
+'''
+Compact representation of a killmail waiting to be posted.
+
+RedisQ packages hold every item and attacker of a kill, and the ESI data
+fetched for posting holds full universe and type records. Only the fields
+needed for routing, embeds and reactions are kept, with attacker fields
+packed into arrays.
+'''
+import calendar
+import time
+import typing
+from array import array
+
+RIG_SLOT_FLAGS = (92, 93, 94)
+RIG_SLOTS_ATTRIBUTE = 1137
+# Slots set from the package, as opposed to while the killmail is processed
+PACKAGE_SLOTS = ('kill_id', 'time', 'solar_system_id', 'value',
+                 'victim_ship_type_id', 'victim_character_id',
+                 'victim_corporation_id', 'victim_alliance_id',
+                 'attacker_corporations', 'attacker_alliances',
+                 'attacker_ship_types', 'rigs')
+
+
+class Killmail:
+    '''The parts of a RedisQ package and its fetched data used by the
+    poster. Missing attacker corporations, alliances and ship types are 0'''
+
+    __slots__ = PACKAGE_SLOTS + ('relevancy', 'destinations', 'names',
+                                 'region_id', 'rig_slots')
+
+    def __init__(self, package: dict):
+        killmail = package['killmail']
+        victim = killmail['victim']
+        attackers = killmail['attackers']
+
+        self.kill_id: int = package['killID']
+        self.time: int = calendar.timegm(time.strptime(
+            killmail['killmail_time'], '%Y-%m-%dT%H:%M:%SZ'))
+        self.solar_system_id: int = killmail['solar_system_id']
+        self.value: float = package['zkb']['totalValue']
+
+        self.victim_ship_type_id: int = victim['ship_type_id']
+        self.victim_character_id: int = victim.get('character_id')
+        self.victim_corporation_id: int = victim.get('corporation_id')
+        self.victim_alliance_id: int = victim.get('alliance_id')
+
+        self.attacker_corporations = array(
+            'q', [attacker.get('corporation_id', 0) for attacker in attackers])
+        self.attacker_alliances = array(
+            'q', [attacker.get('alliance_id', 0) for attacker in attackers])
+        self.attacker_ship_types = array(
+            'q', [attacker.get('ship_type_id', 0) for attacker in attackers])
+        self.rigs: int = sum(1 for item in victim.get('items', ())
+                             if item['flag'] in RIG_SLOT_FLAGS)
+
+        self.relevancy = None
+        self.destinations: typing.Dict[str, typing.Any] = None
+        self.names: typing.Dict[str, str] = None
+        self.region_id: int = None
+        self.rig_slots: int = None
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'Killmail':
+        'Recreate an unprocessed killmail from the result of get_state'
+        killmail = cls.__new__(cls)
+        for slot in PACKAGE_SLOTS:
+            value = state[slot]
+            if isinstance(value, list):
+                value = array('q', value)
+            setattr(killmail, slot, value)
+        for slot in cls.__slots__[len(PACKAGE_SLOTS):]:
+            setattr(killmail, slot, None)
+        return killmail
+
+    def get_state(self) -> dict:
+        'The fields taken from the package, as JSON serialisable values'
+        state = {}
+        for slot in PACKAGE_SLOTS:
+            value = getattr(self, slot)
+            state[slot] = value.tolist() if isinstance(value, array) else value
+        return state
+
+    def __repr__(self):
+        return '<Killmail {}>'.format(self.kill_id)
+
+    @property
+    def attackers(self) -> typing.Iterator[typing.Tuple[int, int]]:
+        'The corporation and alliance of each attacker'
+        return zip(self.attacker_corporations, self.attacker_alliances)
+
+    def set_data(self, data: dict):
+        'Keep the names, region and rig slots from the fetched ESI data'
+        self.names = {name: value['name'] for name, value in data.items()}
+        self.region_id = data['region']['region_id']
+        for attribute in data['ship_type'].get('dogma_attributes', ()):
+            if attribute['attribute_id'] == RIG_SLOTS_ATTRIBUTE:
+                self.rig_slots = attribute['value']
+                break
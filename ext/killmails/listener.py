@@ -4,18 +4,35 @@ Killmail fetching cog for antinub-gregbot project.
 Polls zKillboard's RedisQ API and dispatches killmails as an event.
 '''
 import asyncio
+import json
+import socket
+import time
+import uuid
+import zlib
+from collections import deque
 
 import aiohttp
 import discord.ext.commands as commands
 
+import utils.checks as checks
+from utils.kvtable import KeyValueTable
 from utils.log import get_logger
 
+from .pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
 from .poster import ZKILLBOARD_BASE_URL
+from .prefilter import KillmailPrefilter
+from .replay import KillmailRecorder, ReplaySink, replay
 
 REDISQ_URL = 'https://redisq.zkillboard.com/listen.php'
 INITIAL_BACKOFF = 0.1
 MAXIMUM_BACKOFF = 3600
 EXPONENTIAL_BACKOFF_FACTOR = 2
+# RedisQ holds a poll open for up to ten seconds when there are no kills
+REDISQ_WAIT = 10
+POLL_TIMEOUT = REDISQ_WAIT + 20
+CONNECT_TIMEOUT = 10
+KEEPALIVE_TIMEOUT = 60
+LATENCY_SAMPLES = 100
 
 
 def setup(bot: commands.Bot):
@@ -25,36 +42,78 @@ def setup(bot: commands.Bot):
 class RedisQListener:
     '''Poll RedisQ and dispatch killmail event containing recieved package'''
     backoff_wait = INITIAL_BACKOFF
+    last_success: float = None
 
     def __init__(self, bot: commands.Bot):
         self.logger = get_logger(__name__, bot)
         self.bot = bot
+        self.config_table = KeyValueTable(self.bot.tdb, 'killmails.config')
+        self.queue_id = self.get_queue_id()
+        self.session = self.create_session()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.errors = 0
+        self.reconnects = 0
+        self.prefilter = KillmailPrefilter()
+        self.recorder: KillmailRecorder = None
         self.redisq_polling_task = self.listen_task_start()
 
     def __unload(self):
         self.redisq_polling_task.cancel()
+        self.session.close()
+        if self.recorder:
+            self.recorder.close()
+
+    def create_session(self) -> aiohttp.ClientSession:
+        '''Create a session for the RedisQ long-poll, separate from the one
+        used for Discord'''
+        family = socket.AF_INET if self.config_table.get(
+            'force_ipv4', False) else 0
+        connector = aiohttp.TCPConnector(
+            family=family,
+            use_dns_cache=True,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            conn_timeout=CONNECT_TIMEOUT,
+            loop=self.bot.loop)
+        return aiohttp.ClientSession(connector=connector, loop=self.bot.loop)
+
+    def get_queue_id(self) -> str:
+        '''Return the RedisQ queueID, creating it on first use.
+
+        RedisQ remembers the position of each queueID, so a stable ID means
+        no killmails are missed or repeated across restarts.'''
+        queue_id = self.config_table.get('queue_id')
+        if not queue_id:
+            queue_id = 'antinub-gregbot-{}'.format(uuid.uuid4().hex[:12])
+            self.config_table['queue_id'] = queue_id
+        return queue_id
 
     def get_health(self):
         'Returns a string describing the status of this cog'
         if not self.redisq_polling_task.done():
-            return '\n  \u2714 Listening'
+            response = '\n  \u2714 Listening'
+        else:
+            response = '\n  \u2716 Not listening'
+        if self.latencies:
+            response += ', mean poll {:.2f}s'.format(
+                sum(self.latencies) / len(self.latencies))
+        response += ', {} errors, {} reconnects'.format(self.errors,
+                                                        self.reconnects)
+
+        if self.recorder:
+            response += '\n  \u2714 Recording to {} ({} responses)'.format(
+                self.recorder.path, self.recorder.recorded)
 
-        return '\n  \u2716 Not listening'
+        return response + self.prefilter.get_health()
 
     def listen_task_start(self) -> asyncio.Task:
-        task = self.bot.loop.create_task(self.wait_for_package())
+        task = self.bot.loop.create_task(self.poll())
         task.add_done_callback(self.listen_task_done)
         return task
 
     def listen_task_done(self, task: asyncio.Task):
         try:
             package = task.result()
-            if package:
-                self.bot.dispatch(
-                    'killmail',
-                    package,
-                    debug_info=ZKILLBOARD_BASE_URL.format(package["killID"]))
-            else:
+            if not package:
                 self.logger.debug('Ignoring null package')
         except asyncio.CancelledError:
             return
@@ -66,17 +125,45 @@ class RedisQListener:
 
         self.redisq_polling_task = self.listen_task_start()
 
+    async def poll(self) -> dict:
+        package = await self.wait_for_package()
+        if package:
+            await self.deliver(package)
+        return package
+
+    async def deliver(self, package: dict):
+        '''Hand the package to the poster's queue, waiting while it is full.
+
+        Dispatch it as an event instead if the poster is not loaded.'''
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is not None:
+            await poster.pipeline.put(package)
+        else:
+            self.bot.dispatch(
+                'killmail',
+                package,
+                debug_info=ZKILLBOARD_BASE_URL.format(package["killID"]))
+
     async def wait_for_package(self):
         delay = min(self.backoff_wait, MAXIMUM_BACKOFF)
         await asyncio.sleep(delay)
+        params = {'queueID': self.queue_id, 'ttw': REDISQ_WAIT}
+        start = time.monotonic()
         try:
-            async with self.bot.http.session.get(REDISQ_URL) as resp:
-                resp.raise_for_status()
-                self.backoff_wait = INITIAL_BACKOFF
-                package = await resp.json()
-                contents: dict = package['package']
-                if contents:
-                    return contents
+            with aiohttp.Timeout(POLL_TIMEOUT):
+                async with self.session.get(REDISQ_URL,
+                                            params=params) as resp:
+                    resp.raise_for_status()
+                    raw = await resp.read()
+            self.latencies.append(time.monotonic() - start)
+            if self.backoff_wait != INITIAL_BACKOFF:
+                self.reconnects += 1
+            self.backoff_wait = INITIAL_BACKOFF
+            self.reached_redisq()
+
+            if self.recorder:
+                self.recorder.record(raw)
+            return self.decode_response(raw)
 
         except (aiohttp.errors.HttpProcessingError,
                 aiohttp.errors.ClientResponseError,
@@ -85,6 +172,7 @@ class RedisQListener:
                 aiohttp.errors.ClientDisconnectedError,
                 aiohttp.errors.ClientTimeoutError,
                 asyncio.TimeoutError) as exception:
+            self.errors += 1
             self.backoff_wait *= EXPONENTIAL_BACKOFF_FACTOR
 
             if hasattr(exception, 'code'):
@@ -94,6 +182,120 @@ class RedisQListener:
                 message = 'Error reaching RedisQ: {}'.format(exception)
             raise FetchError(message)
 
+    def reached_redisq(self):
+        '''Record a successful poll, backfilling any killmails missed if
+        RedisQ had been unreachable for a while'''
+        previous, self.last_success = self.last_success, time.time()
+        poster = self.bot.get_cog('KillmailPoster')
+        if previous is not None and poster is not None:
+            poster.backfill.schedule(previous)
+
+    def decode_response(self, raw: bytes) -> dict:
+        '''Return the package contained in a RedisQ response, or None if it
+        is empty or cannot be relevant'''
+        poster = self.bot.get_cog('KillmailPoster')
+        routing = getattr(poster, 'routing', None)
+        if self.prefilter.matches(raw, routing):
+            package = json.loads(raw.decode('utf-8'))
+            contents: dict = package['package']
+            if contents:
+                return contents
+        return None
+
+    async def replay_response(self, raw: bytes, sink: ReplaySink = None):
+        '''Decode a recorded response and hand it to sink, or to the poster
+        as a live response would be if there is no sink'''
+        package = self.decode_response(raw)
+        if package:
+            if sink is not None:
+                await sink.put(package)
+            else:
+                await self.deliver(package)
+
+    def create_sink(self) -> ReplaySink:
+        '''Create a sink routing killmails with the poster's routing table,
+        or treating them all as relevant to one channel without it'''
+        poster = self.bot.get_cog('KillmailPoster')
+        return ReplaySink(
+            self.bot.loop, poster.routing.match if poster is not None else
+            lambda killmail: {None: None}, self.logger,
+            self.config_table.get('workers', DEFAULT_WORKERS),
+            self.config_table.get('queue_size', DEFAULT_QUEUE_SIZE))
+
+    @commands.group(pass_context=True)
+    @commands.check(checks.is_owner)
+    async def redisq(self, ctx):
+        'Group of commands for recording and replaying the RedisQ feed'
+        if not ctx.invoked_subcommand:
+            resp = ('Usage: {}redisq [record | stoprecording | '
+                    'replay <path> [speed] [dry | live]]')
+            await self.bot.say(resp.format(ctx.prefix))
+
+    @redisq.command()
+    async def record(self, path: str = 'redisq.jsonl.gz'):
+        'Append every RedisQ response to the given archive'
+        if self.recorder:
+            self.recorder.close()
+        self.recorder = KillmailRecorder(path)
+        await self.bot.say('Recording RedisQ responses to `{}`'.format(path))
+
+    @redisq.command()
+    async def stoprecording(self):
+        'Stop recording RedisQ responses'
+        if not self.recorder:
+            await self.bot.say('Not recording')
+            return
+        self.recorder.close()
+        await self.bot.say('Recorded {} responses to `{}`'.format(
+            self.recorder.recorded, self.recorder.path))
+        self.recorder = None
+
+    @redisq.command(name='replay')
+    async def redisq_replay(self, path: str = '', speed: str = '1',
+                            mode: str = 'dry'):
+        '''Feed an archive through the listener at a multiple of real time,
+        or as fast as possible if speed is "max".
+
+        Killmails go to stand-ins for ESI and Discord unless mode is "live",
+        which posts them to the routed channels and records them as seen.'''
+        if not path:
+            await self.bot.say('You must specify an archive to replay')
+            return
+        try:
+            speed = None if speed == 'max' else float(speed.rstrip('x'))
+        except ValueError:
+            await self.bot.say('Speed must be a number or "max"')
+            return
+
+        if mode not in ('dry', 'live'):
+            await self.bot.say('Mode must be "dry" or "live"')
+            return
+
+        sink = self.create_sink() if mode == 'dry' else None
+        start = time.monotonic()
+        try:
+            count = await replay(
+                path, lambda raw: self.replay_response(raw, sink), speed)
+            if sink is not None:
+                await sink.join()
+            else:
+                poster = self.bot.get_cog('KillmailPoster')
+                if poster is not None:
+                    await poster.pipeline.queue.join()
+        except (OSError, ValueError, EOFError, zlib.error) as exception:
+            await self.bot.say('Failed to replay `{}`: {}'.format(
+                path, exception))
+            return
+        finally:
+            if sink is not None:
+                sink.close()
+        elapsed = time.monotonic() - start
+        response = 'Replayed {} responses in {:.1f}s ({:.1f}/s)'.format(
+            count, elapsed, count / elapsed if elapsed else 0)
+        if sink is not None:
+            response += '\n' + sink.summary()
+        await self.bot.say(response)
+
     def process_result(self, package: dict):
         raise NotImplementedError
 
@@ -0,0 +1,140 @@
+'''
+Bounded queue and worker pool between the RedisQ listener and the poster.
+
+Packages are reduced to Killmails as they are queued. Putting into a full
+queue blocks, which holds up RedisQ polling until the workers catch up.
+Killmails which cannot be queued in time are dropped. Killmails still
+queued or being handled when the pipeline is closed are saved to a file
+and queued again when it is next created.
+'''
+import asyncio
+import json
+import os
+import time
+import typing
+from collections import deque
+
+from .killmail import Killmail
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+PUT_TIMEOUT = 60
+QUEUE_PATH = "killmails.queue"
+LAG_SAMPLES = 100
+
+
+class KillmailPipeline:
+    '''Feeds queued killmail packages to a handler from several workers'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 handler: typing.Callable, on_error: typing.Callable,
+                 logger, workers: int = DEFAULT_WORKERS,
+                 maxsize: int = DEFAULT_QUEUE_SIZE, path: str = None):
+        self.handler = handler
+        self.on_error = on_error
+        self.logger = logger
+        self.path = path
+        self.queue = asyncio.Queue(maxsize, loop=loop)
+        self.active: typing.Set[Killmail] = set()
+        self.workers = [
+            loop.create_task(self.work()) for _ in range(workers)
+        ]
+
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.restored = 0
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.unrestored = deque(self.load())
+        self.restore_task = loop.create_task(self.restore())
+
+    def close(self):
+        'Stop the workers, saving anything still queued or being handled'
+        self.restore_task.cancel()
+        for worker in self.workers:
+            worker.cancel()
+        killmails = list(self.active) + list(self.unrestored)
+        while not self.queue.empty():
+            killmails.append(self.queue.get_nowait())
+        self.save(killmails)
+
+    def save(self, killmails: typing.List[Killmail]):
+        'Write unprocessed killmails to the queue file'
+        if self.path is None or not killmails:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as queue_file:
+            for killmail in killmails:
+                queue_file.write(json.dumps(killmail.get_state()) + '\n')
+        os.replace(temporary, self.path)
+        self.logger.info("Saved %d unprocessed killmails", len(killmails))
+
+    def load(self) -> typing.List[Killmail]:
+        'Read and remove the killmails saved by a previous pipeline'
+        if self.path is None:
+            return []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as queue_file:
+                killmails = [
+                    Killmail.from_state(json.loads(line))
+                    for line in queue_file if line.strip()
+                ]
+        except FileNotFoundError:
+            return []
+        except (ValueError, KeyError):
+            self.logger.exception("Discarding unreadable killmail queue")
+            killmails = []
+        os.remove(self.path)
+        return killmails
+
+    async def restore(self):
+        'Queue the killmails saved by a previous pipeline'
+        while self.unrestored:
+            await self.queue.put(self.unrestored[0])
+            self.unrestored.popleft()
+            self.restored += 1
+
+    async def put(self, package: dict):
+        'Queue a package, waiting for space but dropping it after a timeout'
+        killmail = Killmail(package)
+        try:
+            await asyncio.wait_for(self.queue.put(killmail), PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            self.logger.warning("Killmail queue full, dropped killmail %s",
+                                killmail.kill_id)
+
+    async def work(self):
+        while True:
+            killmail = await self.queue.get()
+            self.active.add(killmail)
+            try:
+                if await self.handler(killmail):
+                    self.record_lag(killmail)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                await self.on_error(killmail)
+            finally:
+                self.active.discard(killmail)
+                self.queue.task_done()
+
+    def record_lag(self, killmail: Killmail):
+        'Record the time between a kill happening and it being posted'
+        self.lags.append(time.time() - killmail.time)
+
+    def get_health(self) -> str:
+        'Returns a string describing the state of the queue'
+        mean_lag = sum(self.lags) / len(self.lags) if self.lags else 0
+        running = sum(1 for worker in self.workers if not worker.done())
+        if running:
+            response = '\n  \u2714 Queue: {}/{}, {} workers'
+        else:
+            response = '\n  \u2716 Queue: {}/{}, {} workers'
+        response += (', {} processed, {} failed, {} dropped, {} restored, '
+                     'mean lag {:.1f}s')
+        return response.format(self.queue.qsize(), self.queue.maxsize,
+                               running, self.processed, self.failed,
+                               self.dropped, self.restored, mean_lag)
@@ -1,23 +1,83 @@
 import asyncio
-import functools
 import typing
 from datetime import datetime
 from enum import Enum
 
-import esipy
-import tinydb
 import discord
 from discord.ext import commands
 
+from core.outbound import PRIORITY_KILLMAIL
 from utils.esicog import EsiCog
+from utils.esinames import NameResolver
+from utils.esischeduler import PRIORITY_BACKGROUND
 from utils.kvtable import KeyValueTable
 from utils.log import get_logger
+from utils.staticdata import StaticData
+
+from .backfill import Backfill
+from .digest import DIGEST_BACKLOG, DIGEST_RATE, KillmailDigest
+from .fetchplan import FetchPlan, FetchStage
+from .history import KillmailHistory
+from .killmail import Killmail
+from .pipeline import (DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, QUEUE_PATH,
+                       KillmailPipeline)
+from .relevancy import RelevancyIndex
+from .routing import RoutingTable
+from .seen import SeenKillmails
 
 ZKILLBOARD_BASE_URL = "https://zkillboard.com/kill/{:d}/"
 EVE_IMAGESERVER_BASE_URL = "https://imageserver.eveonline.com/Type/{:d}_64.png"
 REGIONAL_INDICATOR_F = "\U0001F1EB"
 ABYSSAL_SPACE_REGIONS = ("12000001", "12000002", "12000003", "12000004",
                          "12000005")
+STATIC_DATA_PATH = "staticdata.bin"
+SEEN_KILLMAILS_PATH = "killmails.seen"
+HISTORY_PATH = "killmails.sqlite3"
+DIGEST_SYSTEMS = 15
+DIGEST_TOP_LOSSES = 5
+
+KILLMAIL_FETCH_STAGES = (
+    FetchStage(
+        "solar_system", (),
+        lambda op, killmail, data: op["get_universe_systems_system_id"](
+            system_id=killmail.solar_system_id),
+        lambda static, killmail, data: static.system(
+            killmail.solar_system_id)),
+    FetchStage(
+        "constellation", ("solar_system", ),
+        lambda op, killmail, data:
+        op["get_universe_constellations_constellation_id"](
+            constellation_id=data["solar_system"]["constellation_id"]),
+        lambda static, killmail, data: static.constellation(
+            data["solar_system"]["constellation_id"])),
+    FetchStage(
+        "region", ("constellation", ),
+        lambda op, killmail, data: op["get_universe_regions_region_id"](
+            region_id=data["constellation"]["region_id"]),
+        lambda static, killmail, data: static.region(
+            data["constellation"]["region_id"])),
+    FetchStage(
+        "ship_type", (),
+        lambda op, killmail, data: op["get_universe_types_type_id"](
+            type_id=killmail.victim_ship_type_id),
+        lambda static, killmail, data: static.ship_type(
+            killmail.victim_ship_type_id)),
+    FetchStage(
+        "character", (),
+        lambda op, killmail, data: op["get_characters_character_id"](
+            character_id=killmail.victim_character_id)
+        if killmail.victim_character_id is not None else None,
+        name_id=lambda killmail: killmail.victim_character_id),
+    FetchStage(
+        "affiliation", (),
+        lambda op, killmail, data: op["get_alliances_alliance_id"](
+            alliance_id=killmail.victim_alliance_id)
+        if killmail.victim_alliance_id is not None else
+        op["get_corporations_corporation_id"](
+            corporation_id=killmail.victim_corporation_id),
+        name_id=lambda killmail: killmail.victim_alliance_id or
+        killmail.victim_corporation_id),
+)
 
 
 def setup(bot: commands.Bot):
@@ -35,6 +95,14 @@ class Relevancy(Enum):
     IRRELEVANT = {}
     LOSSMAIL = {"colour": discord.Colour(0x7a0000)}
     KILLMAIL = {"colour": discord.Colour(0x007a00)}
+    OTHER = {"colour": discord.Colour(0x7a7a7a)}
+
+
+ROUTE_RELEVANCIES = {
+    "loss": Relevancy.LOSSMAIL,
+    "kill": Relevancy.KILLMAIL,
+    "other": Relevancy.OTHER,
+}
 
 
 class KillmailPoster(EsiCog):
@@ -44,179 +112,311 @@ class KillmailPoster(EsiCog):
         self.logger = get_logger(__name__, bot)
         self.bot = bot
         self.config_table = KeyValueTable(self.bot.tdb, "killmails.config")
-        self.channel = self.bot.get_channel(self.config_table["channel"])
-        self.esi_client = esipy.EsiClient(retry_requests=True)
         self.rigs_emoji = None
-        for emoji in self.channel.server.emojis:
+        for emoji in self.bot.get_all_emojis():
             if str(emoji) == self.config_table["rigs_emoji"]:
                 self.rigs_emoji = emoji
                 break
         self.magnate_emoji = None
-        for emoji in self.channel.server.emojis:
+        for emoji in self.bot.get_all_emojis():
             if str(emoji) == self.config_table["magnate_emoji"]:
                 self.magnate_emoji = emoji
                 break
-        self.relevancy_table = self.bot.tdb.table("killmails.relevancies")
-        self.relevancy = tinydb.Query()
+        self.relevancy_index = RelevancyIndex(
+            self.bot.tdb.table("killmails.relevancies"),
+            self.get_alliance_corporations, self.logger)
+        self.relevancy_task = self.bot.loop.create_task(
+            self.relevancy_index.run())
+        self.routing = RoutingTable(self.bot.tdb.table("killmails.routes"),
+                                    self.relevancy_index,
+                                    self.get_default_routes(), self.logger)
+        self.static_data = self.load_static_data()
+        self.seen = SeenKillmails(
+            self.config_table.get("seen_path", SEEN_KILLMAILS_PATH))
+        self.processing: typing.Set[int] = set()
+        self.history = KillmailHistory(
+            self.config_table.get("history_path", HISTORY_PATH))
+        self.name_resolver = NameResolver(self.get_esi_app, self.esi_request,
+                                          self.logger)
+        self.fetch_plan = FetchPlan(KILLMAIL_FETCH_STAGES, self.static_data,
+                                    self.name_resolver)
+        self.pipeline = KillmailPipeline(
+            self.bot.loop, self.process_killmail, self.on_killmail_error,
+            self.logger, self.config_table.get("workers", DEFAULT_WORKERS),
+            self.config_table.get("queue_size", DEFAULT_QUEUE_SIZE),
+            self.config_table.get("queue_path", QUEUE_PATH))
+        self.digest = KillmailDigest(
+            self.bot.loop, self.post_digest, self.pipeline.queue.qsize,
+            self.logger, self.config_table.get("digest_rate", DIGEST_RATE),
+            self.config_table.get("digest_backlog", DIGEST_BACKLOG))
+        self.backfill = Backfill(self)
+        self.backfill.schedule(self.backfill.last_kill_time)
+
+    def __unload(self):
+        self.pipeline.close()
+        self.digest.close()
+        self.backfill.close()
+        self.relevancy_task.cancel()
+        self.seen.close()
+        self.history.close()
+        if self.static_data is not None:
+            self.static_data.close()
+
+    def get_default_routes(self) -> typing.List[dict]:
+        '''Routes used while the killmails.routes table is empty: everything
+        tracked, and losses above others_value million ISK, to the channel'''
+        routes = []
+        channel = self.config_table.get("channel")
+        if channel is not None:
+            routes.append({"channel": channel})
+            others_value = self.config_table.get("others_value", 0)
+            if others_value:
+                routes.append({
+                    "channel": channel,
+                    "open": True,
+                    "min_value": others_value * 1000000
+                })
+        return routes
+
+    def load_static_data(self) -> StaticData:
+        path = self.config_table.get("static_data_path", STATIC_DATA_PATH)
+        try:
+            return StaticData(path)
+        except (OSError, ValueError) as exception:
+            self.logger.warning(
+                "Static data unavailable, using ESI for universe data: %s",
+                exception)
+            return None
+
+    def get_health(self):
+        'Returns a string describing the status of this cog'
+        seen = "\n  \u2714 Seen: {} recent killmails, {} duplicates skipped"
+        seen = seen.format(len(self.seen), self.seen.duplicates)
+        return (self.pipeline.get_health() + seen +
+                self.digest.get_health() +
+                self.relevancy_index.get_health() +
+                self.routing.get_health() +
+                self.fetch_plan.get_health() +
+                self.name_resolver.get_health() +
+                self.history.get_health() + self.backfill.get_health() +
+                self.get_esi_health())
 
     async def on_killmail(self, package: dict, **dummy_kwargs):
-        package["relevancy"] = await self.is_relevant(package)
-        if package["relevancy"] is Relevancy.IRRELEVANT:
+        await self.pipeline.put(package)
+
+    async def on_killmail_error(self, killmail: Killmail):
+        await self.bot.on_error(
+            "killmail",
+            debug_info=ZKILLBOARD_BASE_URL.format(killmail.kill_id))
+
+    async def process_killmail(self, killmail: Killmail) -> bool:
+        '''Post the killmail if it is relevant, returning whether it was'''
+        self.measure_esi_app_wait()
+        await self.relevancy_index.ready.wait()
+        self.backfill.observe(killmail)
+        killmail.destinations = self.get_destinations(killmail)
+        killmail.relevancy = min(
+            killmail.destinations.values(),
+            key=list(Relevancy).index, default=Relevancy.IRRELEVANT)
+        if killmail.relevancy is Relevancy.IRRELEVANT:
             self.logger.debug("Ignoring irrelevant killmail")
+            return False
+        if killmail.kill_id in self.seen or \
+                killmail.kill_id in self.processing:
+            self.seen.duplicates += 1
+            self.logger.debug("Ignoring already posted killmail %s",
+                              killmail.kill_id)
+            return False
+        # A killmail is only marked seen once it has been posted, so one
+        # interrupted by a reload is posted when the saved queue is restored.
+        self.processing.add(killmail.kill_id)
+        try:
+            killmail.set_data(await self.fetch_data(killmail))
+            self.history.add(killmail)
+            if self.digest.observe():
+                self.digest.add(killmail)
+                self.seen.add(killmail.kill_id)
+                return True
+            self.logger.info("Posting %s",
+                             ZKILLBOARD_BASE_URL.format(killmail.kill_id))
+            results = await asyncio.gather(
+                *(self.post_killmail(killmail, channel_id, relevancy)
+                  for channel_id, relevancy in
+                  killmail.destinations.items()),
+                return_exceptions=True)
+            self.seen.add(killmail.kill_id)
+        finally:
+            self.processing.discard(killmail.kill_id)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return True
+
+    async def post_killmail(self, killmail: Killmail, channel_id: str,
+                            relevancy: Relevancy):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            self.logger.warning("Killmail channel %s not found", channel_id)
             return
-        self.logger.info("Posting %s",
-                         ZKILLBOARD_BASE_URL.format(package["killID"]))
-        package["data"] = await self.fetch_data(package)
-        embed = await self.generate_embed(package)
-        message = await self.bot.send_message(self.channel, embed=embed)
-        await self.add_reactions(message, package)
-
-    async def add_reactions(self, message: discord.Message, package: dict):
-        relevancy = package["relevancy"]
+        embed = await self.generate_embed(killmail, relevancy)
+        outbound = self.bot.get_cog("Outbound")
+        message = await outbound.send_message(channel, embed=embed,
+                                              priority=PRIORITY_KILLMAIL)
+        # Reactions are added in the background so the next post need not
+        # wait for them.
+        emojis = self.get_reactions(killmail, relevancy)
+        if emojis:
+            outbound.add_reactions(message, emojis, PRIORITY_KILLMAIL)
+
+    def get_reactions(self, killmail: Killmail,
+                      relevancy: Relevancy) -> list:
+        emojis = []
         if relevancy is Relevancy.LOSSMAIL:
-            await self.bot.add_reaction(message, REGIONAL_INDICATOR_F)
+            emojis.append(REGIONAL_INDICATOR_F)
+
+        if self.rigs_emoji and self.should_add_rig_emoji(killmail):
+            emojis.append(self.rigs_emoji)
 
-        if self.rigs_emoji and self.should_add_rig_emoji(package):
-            await self.bot.add_reaction(message, self.rigs_emoji)
+        if self.magnate_emoji and self.should_add_magnate_emoji(killmail):
+            emojis.append(self.magnate_emoji)
 
-        if self.magnate_emoji and self.should_add_magnate_emoji(package):
-            await self.bot.add_reaction(message, self.magnate_emoji)
+        return emojis
 
-    def should_add_rig_emoji(self, package: dict) -> bool:
-        # Flags 92, 93, 94 are rig slots
-        slots = [val["flag"] for val in package["killmail"]["victim"]["items"]]
-        number_of_rigs = len(list(filter(lambda x: x in (92, 93, 94), slots)))
-        max_rigs = list(
-            filter(
-                # number of rig slots on ship
-                lambda x: x["attribute_id"] == 1137,
-                package["data"]["ship_type"]["dogma_attributes"]))
-        if max_rigs and number_of_rigs < max_rigs[0]["value"]:
-            return True
+    def should_add_rig_emoji(self, killmail: Killmail) -> bool:
+        if self.static_data is not None:
+            rig_slots = self.static_data.rig_slots(
+                killmail.victim_ship_type_id)
+            if rig_slots is not None:
+                return killmail.rigs < rig_slots
 
-        return False
+        return (killmail.rig_slots is not None and
+                killmail.rigs < killmail.rig_slots)
 
-    def should_add_magnate_emoji(self, package: dict) -> bool:
+    def should_add_magnate_emoji(self, killmail: Killmail) -> bool:
         magnate_ship_id = 29248
-        if package["killmail"]["victim"].get("ship_type_id", None) == magnate_ship_id:
-            return True
+        return (killmail.victim_ship_type_id == magnate_ship_id
+                or magnate_ship_id in killmail.attacker_ship_types)
 
-        for attacker in package["killmail"]["attackers"]:
-            if attacker.get("ship_type_id", None) == magnate_ship_id:
-                return True
+    @staticmethod
+    def get_names(killmail: Killmail) -> dict:
+        'Returns the names of the fetched data and how to describe the kill'
+        names = dict(killmail.names)
+
+        names["identity"] = names["affiliation"]
+        if "character" in names:
+            names["identity"] = "{0[character]} ({0[affiliation]})".format(
+                names)
 
-        return False
+        names["location"] = "{0[solar_system]} ({0[region]})".format(names)
+        if str(killmail.region_id) in ABYSSAL_SPACE_REGIONS:
+            names["solar_system"] = "Abyssal Space"
+            names["location"] = names["solar_system"]
+        return names
 
-    async def generate_embed(self, package: dict) -> discord.Embed:
+    async def generate_embed(self, killmail: Killmail,
+                             relevancy: Relevancy) -> discord.Embed:
         embed = discord.Embed()
-        data = package["data"]
-        names = {k: v["name"] for (k, v) in data.items()}
+        names = self.get_names(killmail)
 
-        identity = names["affiliation"]
-        if "character" in names:
-            identity = "{0[character]} ({0[affiliation]})".format(names)
-
-        solar_system = names["solar_system"]
-        location = "{0[solar_system]} ({0[region]})".format(names)
-        if names["region"] in ABYSSAL_SPACE_REGIONS:
-            solar_system = "Abyssal Space"
-            location = solar_system
-
-        embed.title = "{solar_system} | {0[ship_type]} | {identity}".format(
-            names, identity=identity, solar_system=solar_system)
-        embed.description = ("{identity} lost their {0[ship_type]} in "
-                             "{location}\n"
+        embed.title = "{solar_system} | {ship_type} | {identity}".format(
+            **names)
+        embed.description = ("{0[identity]} lost their {0[ship_type]} in "
+                             "{0[location]}\n"
                              "Total Value: {1:,} ISK\n"
-                             "\u200b").format(
-                                 names,
-                                 package["zkb"]["totalValue"],
-                                 identity=identity,
-                                 location=location)
-        embed.url = ZKILLBOARD_BASE_URL.format(package["killID"])
-        embed.timestamp = datetime.strptime(
-            package["killmail"]["killmail_time"], "%Y-%m-%dT%H:%M:%SZ")
-        embed.colour = package["relevancy"].colour
-        ship_type_id = package["killmail"]["victim"]["ship_type_id"]
-        embed.set_thumbnail(url=EVE_IMAGESERVER_BASE_URL.format(ship_type_id))
+                             "\u200b").format(names, killmail.value)
+        embed.url = ZKILLBOARD_BASE_URL.format(killmail.kill_id)
+        embed.timestamp = datetime.utcfromtimestamp(killmail.time)
+        embed.colour = relevancy.colour
+        embed.set_thumbnail(url=EVE_IMAGESERVER_BASE_URL.format(
+            killmail.victim_ship_type_id))
 
         return embed
 
-    async def fetch_data(self, package: dict) -> dict:
-        esi_app = await self.get_esi_app()
-        esi_request = functools.partial(self.esi_request, self.bot.loop,
-                                        self.esi_client)
-        data = {}
-
-        operation = esi_app.op["get_universe_systems_system_id"](
-            system_id=package["killmail"]["solar_system_id"])
-        response = await esi_request(operation)
-        data["solar_system"] = response.data
-
-        operation = esi_app.op["get_universe_constellations_constellation_id"](
-            constellation_id=response.data["constellation_id"])
-        response = await esi_request(operation)
-        operation = esi_app.op["get_universe_regions_region_id"](
-            region_id=response.data["region_id"])
-        response = await esi_request(operation)
-        data["region"] = response.data
-
-        operation = esi_app.op["get_universe_types_type_id"](
-            type_id=package["killmail"]["victim"]["ship_type_id"])
-        response = await esi_request(operation)
-        data["ship_type"] = response.data
-
-        if "character_id" in package["killmail"]["victim"]:
-            operation = esi_app.op["get_characters_character_id"](
-                character_id=package["killmail"]["victim"]["character_id"])
-            response = await esi_request(operation)
-            data["character"] = response.data
-
-        if "alliance_id" in package["killmail"]["victim"]:
-            operation = esi_app.op["get_alliances_alliance_id"](
-                alliance_id=package["killmail"]["victim"]["alliance_id"])
-            response = await esi_request(operation)
-            data["affiliation"] = response.data
-        else:
-            operation = esi_app.op["get_corporations_corporation_id"](
-                corporation_id=package["killmail"]["victim"]["corporation_id"])
-            response = await esi_request(operation)
-            data["affiliation"] = response.data
-
-        return data
-
-    async def is_relevant(self, package: dict) -> Relevancy:
-        relevant_corporations = await self.get_relevant_corporations()
-
-        victim = package["killmail"]["victim"]
-        if victim["corporation_id"] in relevant_corporations:
-            return Relevancy.LOSSMAIL
-
-        for attacker in package["killmail"]["attackers"]:
-            if "corporation_id" not in attacker:
-                continue  # Some NPCs do not have a corporation.
-            if attacker["corporation_id"] in relevant_corporations:
-                return Relevancy.KILLMAIL
-
-        return Relevancy.IRRELEVANT
-
-    async def get_relevant_corporations(self) -> typing.Set[int]:
-        corp_configs = self.relevancy_table.search(
-            self.relevancy.type == "corporation")
-        corp_list = set([entry["value"] for entry in corp_configs])
-
-        alliance_configs = self.relevancy_table.search(
-            self.relevancy.type == "alliance")
-        alliance_list = [entry["value"] for entry in alliance_configs]
-
-        esi_app = await self.get_esi_app()
-        esi_request = functools.partial(self.esi_request, self.bot.loop,
-                                        self.esi_client)
-        operations = [
-            esi_app.op["get_alliances_alliance_id_corporations"](
-                alliance_id=alliance_id) for alliance_id in alliance_list
+    async def post_digest(self, killmails: typing.List[Killmail]):
+        'Post a digest of the given killmails to each of their channels'
+        channels = {}
+        for killmail in killmails:
+            for channel_id, relevancy in killmail.destinations.items():
+                channels.setdefault(channel_id, []).append(
+                    (killmail, relevancy))
+
+        outbound = self.bot.get_cog("Outbound")
+        posts = []
+        for channel_id, kills in channels.items():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                self.logger.warning("Killmail channel %s not found",
+                                    channel_id)
+                continue
+            posts.append(outbound.send_message(
+                channel, embed=self.generate_digest_embed(kills),
+                priority=PRIORITY_KILLMAIL))
+        await asyncio.gather(*posts)
+
+    def generate_digest_embed(
+            self, kills: typing.List[typing.Tuple[Killmail, Relevancy]]
+    ) -> discord.Embed:
+        'Summarise many kills by system, with the most valuable losses'
+        embed = discord.Embed()
+        killmails = [killmail for killmail, _ in kills]
+        systems = {}
+        kill_value = loss_value = 0
+        for killmail, relevancy in kills:
+            names = self.get_names(killmail)
+            value = killmail.value
+            if relevancy is Relevancy.LOSSMAIL:
+                loss_value += value
+            else:
+                kill_value += value
+            system = systems.setdefault(names["location"], [0, 0, 0])
+            system[0] += relevancy is Relevancy.KILLMAIL
+            system[1] += relevancy is Relevancy.LOSSMAIL
+            system[2] += value
+
+        embed.title = "{:,} killmails | {:,.0f} ISK".format(
+            len(killmails), kill_value + loss_value)
+        lines = [
+            "**{}**: {} kills, {} losses, {:,.0f} ISK".format(
+                location, kills, losses, value)
+            for location, (kills, losses, value) in sorted(
+                systems.items(), key=lambda item: -item[1][2])
         ]
-        responses = await asyncio.gather(*map(esi_request, operations))
-        for response in responses:
-            corp_list.update(response.data)
+        if len(lines) > DIGEST_SYSTEMS:
+            lines[DIGEST_SYSTEMS:] = ["and {} more systems".format(
+                len(lines) - DIGEST_SYSTEMS)]
+        embed.description = "\n".join(lines) + "\n\u200b"
+
+        top = sorted(killmails, key=lambda killmail: killmail.value,
+                     reverse=True)[:DIGEST_TOP_LOSSES]
+        embed.add_field(
+            name="Top losses",
+            value="\n".join(
+                "[{0[ship_type]} | {0[identity]}]({1}) {2:,.0f} ISK".format(
+                    self.get_names(killmail),
+                    ZKILLBOARD_BASE_URL.format(killmail.kill_id),
+                    killmail.value) for killmail in top))
+        embed.timestamp = datetime.utcfromtimestamp(
+            max(killmail.time for killmail in killmails))
+        embed.colour = (Relevancy.KILLMAIL.colour if kill_value >= loss_value
+                        else Relevancy.LOSSMAIL.colour)
+        return embed
 
-        return corp_list
+    async def fetch_data(self, killmail: Killmail) -> dict:
+        esi_app = await self.get_esi_app()
+        return await self.fetch_plan.run(esi_app, self.esi_request, killmail)
+
+    def get_destinations(self,
+                         killmail: Killmail) -> typing.Dict[str, Relevancy]:
+        'Returns the channels to post a killmail to and how it relates to each'
+        channels = self.routing.match(killmail)
+        return {
+            channel_id: ROUTE_RELEVANCIES[direction]
+            for channel_id, (_, direction) in channels.items()
+        }
+
+    async def get_alliance_corporations(self, alliance_id: int) -> list:
+        esi_app = await self.get_esi_app()
+        operation = esi_app.op["get_alliances_alliance_id_corporations"](
+            alliance_id=alliance_id)
+        response = await self.esi_request(operation, PRIORITY_BACKGROUND)
+        return response.data
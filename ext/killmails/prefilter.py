@@ -0,0 +1,79 @@
+'''
+Cheap relevancy check on raw RedisQ responses.
+
+Most killmails involve no routed corporation or alliance, so the IDs in
+the undecoded response are compared against the routing table and
+irrelevant killmails are dropped before being decoded as JSON. If there
+are open routes, killmails worth enough for one of them are kept as well.
+'''
+import re
+import time
+import typing
+
+from .routing import RoutingTable
+
+ENTITY_ID_PATTERN = re.compile(rb'"(?:corporation|alliance)_id"\s*:\s*(\d+)')
+NULL_PACKAGE_PATTERN = re.compile(rb'\s*\{\s*"package"\s*:\s*null')
+TOTAL_VALUE_PATTERN = re.compile(rb'"totalValue"\s*:\s*([-+.\deE]+)')
+
+
+class KillmailPrefilter:
+    '''Matches raw responses against the routed corporation and alliance IDs
+    of a RoutingTable'''
+
+    def __init__(self):
+        self.source: tuple = None
+        self.tracked: typing.FrozenSet[bytes] = frozenset()
+
+        self.scanned = 0
+        self.filtered = 0
+        self.filtered_bytes = 0
+        self.scan_time = 0.0
+
+    def compile(self, routing: RoutingTable):
+        'Rebuild the set of routed IDs if the routing table has changed'
+        routing.compile()
+        source = (routing.corporations, routing.alliances)
+        if self.source is None or any(
+                new is not old for new, old in zip(source, self.source)):
+            self.source = source
+            self.tracked = frozenset(
+                str(entity_id).encode() for ids in source for entity_id in ids)
+
+    def matches(self, raw: bytes, routing: RoutingTable = None) -> bool:
+        '''Return whether raw may contain a relevant killmail.
+
+        Null packages never match, anything matches without a ready routing
+        table.
+        '''
+        if NULL_PACKAGE_PATTERN.match(raw):
+            return False
+        if routing is None or not routing.ready:
+            return True
+
+        start = time.perf_counter()
+        self.compile(routing)
+        tracked = self.tracked
+        relevant = any(entity_id in tracked
+                       for entity_id in ENTITY_ID_PATTERN.findall(raw))
+        if not relevant and routing.open_value is not None:
+            value = TOTAL_VALUE_PATTERN.search(raw)
+            try:
+                relevant = value is None or \
+                    float(value.group(1)) >= routing.open_value
+            except ValueError:
+                relevant = True
+        self.scan_time += time.perf_counter() - start
+        self.scanned += 1
+        if not relevant:
+            self.filtered += 1
+            self.filtered_bytes += len(raw)
+        return relevant
+
+    def get_health(self) -> str:
+        'Returns a string describing the work done by the prefilter'
+        mean_scan = self.scan_time / self.scanned if self.scanned else 0
+        return ('\n  \u2714 Prefilter: {} of {} killmails dropped undecoded '
+                '({:.1f} MiB), mean scan {:.2f}ms').format(
+                    self.filtered, self.scanned,
+                    self.filtered_bytes / 2**20, 1000 * mean_scan)
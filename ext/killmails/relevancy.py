@@ -0,0 +1,131 @@
+'''
+In-memory index of the corporations and alliances tracked for killmails.
+
+The index is refreshed in the background so that deciding whether a killmail
+is relevant never touches TinyDB or ESI.
+'''
+import asyncio
+import time
+import typing
+
+import tinydb
+
+SYNC_INTERVAL = 30
+ALLIANCE_TTL = 3600
+
+
+class RelevancyIndex:
+    '''Tracked corporation and alliance IDs, kept in sync with the relevancy
+    table and refreshed from ESI on a TTL'''
+
+    def __init__(self, table: tinydb.database.Table,
+                 fetch_members: typing.Callable, logger,
+                 ttl: float = ALLIANCE_TTL):
+        self.table = table
+        self.fetch_members = fetch_members
+        self.logger = logger
+        self.ttl = ttl
+        self.query = tinydb.Query()
+
+        self.corporations: typing.FrozenSet[int] = frozenset()
+        self.alliances: typing.FrozenSet[int] = frozenset()
+        self.members: typing.Dict[int, typing.FrozenSet[int]] = {}
+        self.fetched: typing.Dict[int, float] = {}
+        self.tracked_corporations: typing.FrozenSet[int] = frozenset()
+
+        self.ready = asyncio.Event()
+        self.last_refresh: float = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def __contains__(self, entity: tuple) -> bool:
+        corporation_id, alliance_id = entity
+        return (corporation_id in self.tracked_corporations
+                or alliance_id in self.alliances)
+
+    @property
+    def age(self) -> float:
+        'Seconds since the index last completed a refresh'
+        if self.last_refresh is None:
+            return None
+        return time.monotonic() - self.last_refresh
+
+    async def run(self):
+        'Keep the index in sync until cancelled'
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failures += 1
+                self.logger.exception('Failed to refresh relevancy index')
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    async def refresh(self):
+        'Apply relevancy table changes and refetch stale alliance members'
+        stale = self.sync()
+        if stale:
+            results = await asyncio.gather(
+                *map(self.fetch_members, stale), return_exceptions=True)
+            for alliance_id, result in zip(stale, results):
+                if isinstance(result, Exception):
+                    self.failures += 1
+                    self.logger.warning(
+                        'Failed to fetch corporations of alliance %s: %s',
+                        alliance_id, result)
+                    continue
+                if alliance_id in self.alliances:
+                    self.members[alliance_id] = frozenset(result)
+                    self.fetched[alliance_id] = time.monotonic()
+            self.rebuild()
+
+        self.last_refresh = time.monotonic()
+        self.refreshes += 1
+        self.ready.set()
+
+    def sync(self) -> typing.List[int]:
+        '''Pick up changes to the relevancy table.
+
+        Returns the alliances whose member corporations need fetching.
+        '''
+        corporations = frozenset(
+            entry['value'] for entry in self.table.search(
+                self.query.type == 'corporation'))
+        alliances = frozenset(
+            entry['value'] for entry in self.table.search(
+                self.query.type == 'alliance'))
+
+        removed = self.alliances - alliances
+        for alliance_id in removed:
+            self.members.pop(alliance_id, None)
+            self.fetched.pop(alliance_id, None)
+
+        changed = corporations != self.corporations or removed
+        self.corporations = corporations
+        self.alliances = alliances
+        if changed:
+            self.rebuild()
+
+        now = time.monotonic()
+        return [
+            alliance_id for alliance_id in alliances
+            if alliance_id not in self.fetched
+            or now - self.fetched[alliance_id] >= self.ttl
+        ]
+
+    def rebuild(self):
+        'Recompute the flattened set of tracked corporations'
+        tracked = set(self.corporations)
+        for members in self.members.values():
+            tracked.update(members)
+        self.tracked_corporations = frozenset(tracked)
+
+    def get_health(self) -> str:
+        'Returns a string describing the state of the index'
+        if self.last_refresh is None:
+            return '\n  \u2716 Relevancy index not yet built'
+        return ('\n  \u2714 Relevancy index: {} corporations, {} alliances, '
+                'refreshed {:.0f}s ago ({} refreshes, {} failures)').format(
+                    len(self.tracked_corporations), len(self.alliances),
+                    self.age, self.refreshes, self.failures)
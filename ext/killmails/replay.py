@@ -0,0 +1,196 @@
+'''
+Recording of raw RedisQ responses and replaying them through the listener.
+
+Archives are gzip compressed JSON lines, each holding the time a response
+was received and the response itself. Every record is a gzip member of its
+own, so an archive still being written, or cut short by a crash, can be
+read up to its last complete record and appended to again.
+
+Replays go to a ReplaySink by default, which routes killmails as the
+poster would but stands in for ESI and Discord with fixed delays, so
+nothing is posted or stored.
+'''
+import asyncio
+import gzip
+import json
+import time
+import typing
+import zlib
+
+from .killmail import Killmail
+from .pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, KillmailPipeline
+
+ESI_DELAY = 0.2
+POST_DELAY = 0.1
+GZIP_MAGIC = b'\x1f\x8b\x08'
+CHUNK_SIZE = 65536
+
+
+class KillmailRecorder:
+    '''Appends raw RedisQ responses to a compressed archive'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.recorded = 0
+
+    def record(self, raw: bytes):
+        # JSON strings cannot contain raw newlines, so removing them keeps
+        # one response per line without changing the content.
+        line = b'{"received": %.3f, "response": %s}\n' % (
+            time.time(), raw.strip().replace(b'\n', b''))
+        self.file.write(gzip.compress(line))
+        self.file.flush()
+        self.recorded += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_members(archive: typing.BinaryIO) -> typing.Iterator[bytes]:
+    '''Yield the decompressed contents of each gzip member of a file.
+
+    Of a member which is corrupt or cut short, only the complete lines
+    before the damage are yielded, and reading carries on from the next
+    member header found after it.'''
+    pending = archive.read(CHUNK_SIZE)
+    while pending:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        member = bytearray(pending)
+        output = []
+        data = pending
+        try:
+            while True:
+                output.append(decompressor.decompress(data))
+                if decompressor.eof:
+                    break
+                data = archive.read(CHUNK_SIZE)
+                if not data:
+                    break
+                member += data
+        except zlib.error:
+            pass
+        if decompressor.eof:
+            yield b''.join(output)
+            pending = decompressor.unused_data or archive.read(CHUNK_SIZE)
+            continue
+
+        following = member.find(GZIP_MAGIC, 1)
+        if following == -1:
+            following = len(member)
+        yield complete_lines(bytes(member[:following]))
+        pending = bytes(member[following:]) or archive.read(CHUNK_SIZE)
+
+
+def complete_lines(member: bytes) -> bytes:
+    'The complete lines at the start of a damaged gzip member'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    contents = b''
+    try:
+        # Small pieces, so that little is lost with the piece which fails
+        for start in range(0, len(member), 1024):
+            contents += decompressor.decompress(member[start:start + 1024])
+    except zlib.error:
+        pass
+    return contents[:contents.rfind(b'\n') + 1]
+
+
+def read_archive(path: str) -> typing.Iterator[typing.Tuple[float, bytes]]:
+    '''Yield the receive time and raw response of each record in an
+    archive, skipping any which are incomplete'''
+    with open(path, 'rb') as archive:
+        for contents in read_members(archive):
+            for line in contents.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                yield record['received'], json.dumps(
+                    record['response']).encode('utf-8')
+
+
+async def replay(path: str, handle: typing.Callable,
+                 speed: float = 1.0) -> int:
+    '''Feed the responses of an archive to handle, returning how many there
+    were.
+
+    Responses are spaced as they were received divided by speed, or sent
+    as fast as handle accepts them if speed is None.'''
+    count = 0
+    previous = None
+    for received, raw in read_archive(path):
+        if speed and previous is not None:
+            await asyncio.sleep(max(0, received - previous) / speed)
+        previous = received
+        await handle(raw)
+        count += 1
+    return count
+
+
+class ReplaySink:
+    '''Takes the place of the poster during a replay.
+
+    Killmails go through a pipeline of their own and are routed with
+    route, then wait esi_delay seconds in place of the ESI lookups and
+    post_delay seconds for each channel in place of the Discord posts. The
+    time from each package being put until it is handled is recorded.'''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 route: typing.Callable, logger,
+                 workers: int = DEFAULT_WORKERS,
+                 maxsize: int = DEFAULT_QUEUE_SIZE,
+                 esi_delay: float = ESI_DELAY,
+                 post_delay: float = POST_DELAY):
+        self.route = route
+        self.logger = logger
+        self.esi_delay = esi_delay
+        self.post_delay = post_delay
+        self.pipeline = KillmailPipeline(loop, self.process, self.on_error,
+                                         logger, workers, maxsize)
+        self.started: typing.Dict[int, float] = {}
+        self.latencies: typing.List[float] = []
+        self.relevant = 0
+        self.posts = 0
+
+    async def put(self, package: dict):
+        self.started[package['killID']] = time.monotonic()
+        await self.pipeline.put(package)
+
+    async def process(self, killmail: Killmail) -> bool:
+        destinations = self.route(killmail)
+        if destinations:
+            self.relevant += 1
+            await asyncio.sleep(self.esi_delay)
+            await asyncio.gather(*(asyncio.sleep(self.post_delay)
+                                   for _ in destinations))
+            self.posts += len(destinations)
+        started = self.started.pop(killmail.kill_id, None)
+        if started is not None:  # Unless the kill was recorded twice
+            self.latencies.append(time.monotonic() - started)
+        return False  # Kill times of a replay say nothing about lag
+
+    async def on_error(self, killmail: Killmail):
+        self.started.pop(killmail.kill_id, None)
+        self.logger.exception('Failed to replay killmail %s',
+                              killmail.kill_id)
+
+    async def join(self):
+        'Wait until every killmail put has been handled'
+        await self.pipeline.queue.join()
+
+    def close(self):
+        self.pipeline.close()
+
+    def summary(self) -> str:
+        'Describe the killmails handled and how long they took'
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 'No killmails reached the sink'
+        return ('{} killmails, {} relevant, {} posts; latency mean '
+                '{:.0f}ms, p95 {:.0f}ms, max {:.0f}ms').format(
+                    len(latencies), self.relevant, self.posts,
+                    1000 * sum(latencies) / len(latencies),
+                    1000 * latencies[int(0.95 * (len(latencies) - 1))],
+                    1000 * latencies[-1])
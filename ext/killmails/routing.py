@@ -0,0 +1,172 @@
+'''
+Routing of relevant killmails to channels.
+
+Each route sends the kills and/or losses of a set of corporations and
+alliances worth at least a minimum value to a channel. Routes without
+entities follow everything in the relevancy index, and open routes take
+any killmail above their minimum value. The routes are compiled into
+dictionaries from entity ID to route so that a killmail is routed in one
+pass over its victim and attackers.
+'''
+import time
+import typing
+from collections import defaultdict, namedtuple
+
+import tinydb
+
+from .killmail import Killmail
+from .relevancy import SYNC_INTERVAL, RelevancyIndex
+
+DIRECTIONS = ("kills", "losses", "both")
+
+Route = namedtuple("Route", ("channel_id", "corporations", "alliances",
+                             "kills", "losses", "min_value", "open"))
+
+
+def parse_route(entry: dict) -> Route:
+    '''Build a route from a killmails.routes table entry, e.g.
+    {"channel": "123", "alliances": [99005492], "direction": "losses",
+    "min_value": 100000000}'''
+    direction = entry.get("direction", "both")
+    if direction not in DIRECTIONS:
+        raise ValueError("Unknown route direction: {}".format(direction))
+    return Route(
+        channel_id=str(entry["channel"]),
+        corporations=frozenset(entry.get("corporations", ())),
+        alliances=frozenset(entry.get("alliances", ())),
+        kills=direction != "losses",
+        losses=direction != "kills",
+        min_value=entry.get("min_value", 0),
+        open=entry.get("open", False))
+
+
+class RoutingTable:
+    '''The routes of the killmails.routes table, compiled against a
+    RelevancyIndex'''
+
+    def __init__(self, table: tinydb.database.Table, index: RelevancyIndex,
+                 default_routes: typing.List[dict], logger):
+        self.table = table
+        self.index = index
+        self.default_routes = default_routes
+        self.logger = logger
+
+        self.routes: typing.List[Route] = []
+        self.corporations: typing.Dict[int, typing.Tuple[int, ...]] = {}
+        self.alliances: typing.Dict[int, typing.Tuple[int, ...]] = {}
+        self.open_routes: typing.Tuple[int, ...] = ()
+        self.open_value: float = None
+
+        self.source: tuple = None
+        self.loaded: float = None
+        self.entries: typing.List[dict] = []
+        self.routed = 0
+        self.route_time = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self.index.ready.is_set()
+
+    def load(self):
+        'Read the routes, falling back to the defaults if there are none'
+        entries = self.table.all() or self.default_routes
+        if entries != self.entries:
+            self.entries = entries
+        self.loaded = time.monotonic()
+
+    def compile(self):
+        'Rebuild the lookup tables if the routes or the index have changed'
+        if self.loaded is None or \
+                time.monotonic() - self.loaded >= SYNC_INTERVAL:
+            self.load()
+        source = (self.entries, self.index.tracked_corporations,
+                  self.index.alliances)
+        if self.source is not None and all(
+                new is old for new, old in zip(source, self.source)):
+            return
+
+        routes = []
+        for entry in self.entries:
+            try:
+                routes.append(parse_route(entry))
+            except (KeyError, TypeError, ValueError) as exception:
+                self.logger.warning("Ignoring invalid route %s: %s", entry,
+                                    exception)
+
+        corporations = defaultdict(list)
+        alliances = defaultdict(list)
+        for number, route in enumerate(routes):
+            if route.open:
+                continue
+            if not route.corporations and not route.alliances:
+                route_corporations = self.index.tracked_corporations
+                route_alliances = self.index.alliances
+            else:
+                route_corporations = set(route.corporations)
+                for alliance_id in route.alliances:
+                    route_corporations.update(
+                        self.index.members.get(alliance_id, ()))
+                route_alliances = route.alliances
+            for corporation_id in route_corporations:
+                corporations[corporation_id].append(number)
+            for alliance_id in route_alliances:
+                alliances[alliance_id].append(number)
+
+        self.routes = routes
+        self.corporations = {
+            entity_id: tuple(numbers)
+            for entity_id, numbers in corporations.items()
+        }
+        self.alliances = {
+            entity_id: tuple(numbers)
+            for entity_id, numbers in alliances.items()
+        }
+        self.open_routes = tuple(
+            number for number, route in enumerate(routes) if route.open)
+        self.open_value = min(
+            (routes[number].min_value for number in self.open_routes),
+            default=None)
+        self.source = source
+
+    def match(self, killmail: Killmail
+              ) -> typing.Dict[str, typing.Tuple[Route, str]]:
+        '''Return the channels a killmail should be posted to, with the
+        route and whether it is a "loss", "kill" or "other" for each'''
+        start = time.perf_counter()
+        self.compile()
+        routes = self.routes
+        corporations = self.corporations
+        alliances = self.alliances
+        matched = {}
+
+        for number in (
+                corporations.get(killmail.victim_corporation_id, ()) +
+                alliances.get(killmail.victim_alliance_id, ())):
+            if routes[number].losses:
+                matched.setdefault(number, "loss")
+        # Some NPCs have neither a corporation nor an alliance, both are 0.
+        for corporation_id, alliance_id in killmail.attackers:
+            for number in (corporations.get(corporation_id, ()) +
+                           alliances.get(alliance_id, ())):
+                if routes[number].kills:
+                    matched.setdefault(number, "kill")
+        for number in self.open_routes:
+            matched.setdefault(number, "other")
+
+        channels = {}
+        for number, direction in sorted(matched.items()):
+            route = routes[number]
+            if killmail.value >= route.min_value:
+                channels.setdefault(route.channel_id, (route, direction))
+        self.routed += 1
+        self.route_time += time.perf_counter() - start
+        return channels
+
+    def get_health(self) -> str:
+        'Returns a string describing the routes'
+        mean_route = self.route_time / self.routed if self.routed else 0
+        return ('\n  \u2714 Routing: {} routes to {} channels, {} killmails '
+                'routed, mean {:.3f}ms').format(
+                    len(self.routes),
+                    len({route.channel_id for route in self.routes}),
+                    self.routed, 1000 * mean_route)
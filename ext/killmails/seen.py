@@ -0,0 +1,81 @@
+'''
+Persistent record of recently posted killmail IDs.
+
+The IDs are kept in a fixed size ring buffer on disk so that restarts and
+reloads do not post the same killmail twice.
+'''
+import struct
+from array import array
+
+DEFAULT_CAPACITY = 10000
+HEADER = struct.Struct('=QQ')  # capacity, next position
+SLOT = struct.Struct('=q')
+
+
+class SeenKillmails:
+    '''A ring buffer of the last capacity killmail IDs, with a set for
+    lookups, written through to a file'''
+
+    def __init__(self, path: str, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.position = 0
+        self.ring = self.load()
+        self.duplicates = 0
+
+        self.ids = set(self.ring)
+        self.ids.discard(0)
+        self.file = open(path, 'r+b')
+
+    def __contains__(self, kill_id: int) -> bool:
+        return kill_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, kill_id: int) -> bool:
+        'Record kill_id, returning False if it was already seen'
+        if kill_id in self.ids:
+            self.duplicates += 1
+            return False
+
+        self.ids.discard(self.ring[self.position])
+        self.ring[self.position] = kill_id
+        self.ids.add(kill_id)
+
+        self.file.seek(HEADER.size + SLOT.size * self.position)
+        self.file.write(SLOT.pack(kill_id))
+        self.position = (self.position + 1) % self.capacity
+        self.file.seek(0)
+        self.file.write(HEADER.pack(self.capacity, self.position))
+        self.file.flush()
+        return True
+
+    def load(self) -> array:
+        '''Read the buffer from disk, starting a new file if it is missing or
+        does not match the capacity'''
+        try:
+            with open(self.path, 'rb') as seen_file:
+                capacity, position = HEADER.unpack(
+                    seen_file.read(HEADER.size))
+                if capacity == self.capacity:
+                    ring = array('q')
+                    ring.fromfile(seen_file, capacity)
+                    self.position = position % capacity
+                    return ring
+        except (OSError, EOFError, struct.error):
+            pass
+
+        ring = array('q', bytes(SLOT.size * self.capacity))
+        self.position = 0
+        self.save(ring)
+        return ring
+
+    def save(self, ring: array):
+        'Write the whole buffer to disk'
+        with open(self.path, 'wb') as seen_file:
+            seen_file.write(HEADER.pack(self.capacity, self.position))
+            ring.tofile(seen_file)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,92 @@
+'''
+Killmail statistics cog made for antinub-gregbot project.
+
+Answers questions about past kills and losses from the poster's local
+killmail history rather than zKillboard.
+'''
+import asyncio
+import functools
+import time
+import typing
+
+from discord.ext import commands
+
+from utils.log import get_logger
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(KillmailStats(bot))
+
+
+class KillmailStats:
+    '''A cog with commands summarising the kills and losses of the tracked
+    corporations and alliances, or of a single one'''
+
+    def __init__(self, bot: commands.Bot):
+        self.logger = get_logger(__name__, bot)
+        self.bot = bot
+
+    async def query(self, method: str, days: float,
+                    entity_id: int = None) -> typing.Any:
+        '''Run a KillmailHistory query off the event loop for the last days,
+        returning None if the poster is not loaded'''
+        poster = self.bot.get_cog('KillmailPoster')
+        if poster is None:
+            return None
+        if entity_id is None:
+            index = poster.relevancy_index
+            corporations, alliances = index.corporations, index.alliances
+        else:
+            # Corporation and alliance IDs never overlap.
+            corporations = alliances = (entity_id, )
+        since = time.time() - days * 24 * 3600
+        return await asyncio.get_event_loop().run_in_executor(
+            None,
+            functools.partial(
+                getattr(poster.history, method), since, corporations,
+                alliances))
+
+    @commands.group(pass_context=True)
+    async def killstats(self, ctx):
+        'Group of commands for statistics from past killmails'
+        if not ctx.invoked_subcommand:
+            resp = 'Usage: {}killstats [summary | systems] [days] [id]'
+            await self.bot.say(resp.format(ctx.prefix))
+
+    @killstats.command()
+    async def summary(self, days: float = 7, entity_id: int = None):
+        '''Kills, losses and ISK efficiency over the last days, of everything
+        tracked or of the given corporation or alliance'''
+        summary = await self.query('summary', days, entity_id)
+        if summary is None:
+            await self.bot.say('Killmails are not loaded')
+            return
+        total = summary.destroyed + summary.lost
+        efficiency = 100 * summary.destroyed / total if total else 0
+        await self.bot.say(
+            '```\nLast {:g} days\n'
+            'Kills:      {:>8,} {:>22,.0f} ISK\n'
+            'Losses:     {:>8,} {:>22,.0f} ISK\n'
+            'Efficiency: {:>8.1f}%\n```'.format(
+                days, summary.kills, summary.destroyed, summary.losses,
+                summary.lost, efficiency))
+
+    @killstats.command()
+    async def systems(self, days: float = 7, entity_id: int = None):
+        '''The systems with the most kills and losses over the last days, of
+        everything tracked or of the given corporation or alliance'''
+        systems = await self.query('top_systems', days, entity_id)
+        if systems is None:
+            await self.bot.say('Killmails are not loaded')
+            return
+        if not systems:
+            await self.bot.say('No killmails in the last {:g} days'.format(
+                days))
+            return
+        lines = [
+            '{:<16} {:>5} kills {:>5} losses {:>22,.0f} ISK'.format(
+                str(system.name), system.kills, system.losses, system.value)
+            for system in systems
+        ]
+        await self.bot.say('```\nLast {:g} days\n{}\n```'.format(
+            days, '\n'.join(lines)))
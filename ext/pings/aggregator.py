@@ -1,15 +1,28 @@
+import asyncio
 import logging
+import time
+from collections import defaultdict, deque
 from datetime import datetime
 
+import aiohttp
+from discord import Colour, HTTPException
 from discord.embeds import Embed
 from discord.ext import commands
 
 from config import JABBER
+from core.outbound import PRIORITY_PING
 from utils.log import get_logger
 from utils.messaging import Paginate, notify_owner
 
+from .dedupe import DuplicateFilter
 from .discordrelay import DiscordRelay
 from .jabberrelay import JabberRelay
+from .outbox import OUTBOX_PATH, PingOutbox
+
+LATENCY_SAMPLES = 100
+INITIAL_RETRY = 1
+MAXIMUM_RETRY = 300
+MAXIMUM_AGE = 24 * 3600  # Give up on pings undelivered for a day
 
 
 def setup(bot: commands.Bot):
@@ -24,8 +37,17 @@ class PingAggregator:
         self.logger = get_logger(__name__, bot)
         self.bot = bot
         self.relays = []
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.failures = defaultdict(int)
+        self.duplicates = DuplicateFilter()
+        self.outbox = PingOutbox(config.get('outbox_path', OUTBOX_PATH))
+        self.tasks = set()
 
         self.create_clients(config)
+        for entry in self.outbox.pending.values():
+            self.logger.info('Resending undelivered message from %s',
+                             entry['package']['sender'])
+            self.start_relay(entry)
 
     def create_clients(self, config):
         'Creates an JabberRelay client for each server specified'
@@ -43,34 +65,115 @@ class PingAggregator:
                 response += relay.get_health()
         else:
             response = '\n  \u2716 No relays initialised'
+        response += self.duplicates.get_health()
+        response += self.outbox.get_health()
+        for channel_id in sorted(set(self.latencies) | set(self.failures)):
+            latencies = self.latencies[channel_id]
+            mean = sum(latencies) / len(latencies) if latencies else 0
+            response += ('\n  \u2714 Channel {}: mean delivery {:.0f}ms, '
+                         '{} failures').format(channel_id, 1000 * mean,
+                                               self.failures[channel_id])
         return response
 
     async def on_broadcast(self, package):
         'Relay message to discord, ignore if it is a duplicate'
         body = package['body']
+        destinations = self.duplicates.filter(body, package['destinations'])
+        if not destinations:
+            self.logger.info('Ignored duplicate message from %s',
+                             package['sender'])
+            return
 
         self.logger.info('Relaying message from %s', package['sender'])
-
+        entry = self.outbox.add(
+            dict(package, destinations=destinations,
+                 embed_colour=package['embed_colour'].value))
+        self.start_relay(entry)
+
+    def start_relay(self, entry):
+        'Deliver an outbox entry in the background until it is done'
+        task = self.bot.loop.create_task(self.relay(entry))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def relay(self, entry):
+        'Send an outbox entry to each of its remaining destinations'
+        package = dict(entry['package'],
+                       embed_colour=Colour(entry['package']['embed_colour']))
         embeds = []
-        paginate = Paginate(body, enclose=('', ''), page_size=1900)
+        paginate = Paginate(package['body'], enclose=('', ''), page_size=1900)
         for page in paginate:
             embed = self.ping_embed(package, page, paginate)
             embeds.append(embed)
 
-        for destination in package['destinations']:
-            channel_id = destination['channel_id']
-            channel = self.bot.get_channel(channel_id)
-
-            if channel:
-                embed = embeds[0]
-                await self.bot.send_message(
-                    channel, embed=embed, content=destination.get('prefix')
-                )  # Only show prefix on first page.
-                for embed in embeds[1:]:
-                    await self.bot.send_message(channel, embed=embed)
-            else:
-                await notify_owner(self.bot,
-                                   ['Invalid channel: {}'.format(channel_id)])
+        start = time.monotonic()
+        await asyncio.gather(*(
+            self.deliver(entry, destination, embeds, start)
+            for destination in package['destinations']
+            if destination['channel_id'] in entry['remaining']))
+
+    async def deliver(self, entry, destination, embeds, start):
+        '''Send the pages of a ping to one destination in order, retrying
+        with backoff until they are all sent, and record how long after start
+        the last page was sent'''
+        channel_id = destination['channel_id']
+        channel = self.bot.get_channel(channel_id)
+        if not channel:
+            await self.give_up(entry, channel_id, 'Invalid channel')
+            return
+
+        outbound = self.bot.get_cog('Outbound')
+        sent = 0
+        delay = INITIAL_RETRY
+        while sent < len(embeds):
+            try:
+                # Only show prefix on first page.
+                content = destination.get('prefix') if sent == 0 else None
+                await outbound.send_message(channel, content,
+                                            embed=embeds[sent],
+                                            priority=PRIORITY_PING)
+                sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                self.failures[channel_id] += 1
+                if not self.is_transient(exception):
+                    await self.give_up(entry, channel_id,
+                                       'Cannot relay to channel', exception)
+                    return
+                if time.time() - entry['time'] > MAXIMUM_AGE:
+                    await self.give_up(entry, channel_id,
+                                       'Gave up relaying to channel',
+                                       exception)
+                    return
+                self.logger.warning(
+                    'Failed to relay message to %s, retrying in %ds',
+                    channel_id, delay, exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, MAXIMUM_RETRY)
+        self.outbox.done(entry, channel_id)
+        self.latencies[channel_id].append(time.monotonic() - start)
+
+    @staticmethod
+    def is_transient(exception: Exception) -> bool:
+        '''Whether a failed send may succeed if retried: Discord server
+        errors, rate limits, connection errors and timeouts'''
+        if isinstance(exception, HTTPException):
+            status = exception.response.status
+            return status >= 500 or status == 429
+        return isinstance(exception, (aiohttp.errors.ClientError,
+                                      asyncio.TimeoutError, OSError))
+
+    async def give_up(self, entry, channel_id, reason, exception=None):
+        'Drop a destination of a ping and tell the owner why'
+        self.logger.error('%s %s, dropping message from %s', reason,
+                          channel_id, entry['package']['sender'],
+                          exc_info=exception)
+        self.outbox.done(entry, channel_id)
+        message = '{}: {}'.format(reason, channel_id)
+        if exception is not None:
+            message += ' ({})'.format(exception)
+        await notify_owner(self.bot, [message])
 
     @staticmethod
     def ping_embed(package, message, paginate):
@@ -96,3 +199,6 @@ class PingAggregator:
     def __unload(self):
         for relay in self.relays:
             relay.disconnect()
+        for task in self.tasks:
+            task.cancel()
+        self.outbox.close()
@@ -0,0 +1,67 @@
+'''
+Suppression of pings relayed more than once.
+
+The same ping often reaches the bot through several relays. Pings are
+identified by a hash of their normalised body, and each destination gets a
+given ping only once within a time window.
+'''
+import hashlib
+import re
+import time
+import typing
+from collections import OrderedDict
+
+DEDUPE_WINDOW = 300
+MAX_ENTRIES = 1000
+WHITESPACE = re.compile(r'\s+')
+
+
+def ping_hash(body: str) -> bytes:
+    'Hash a ping body ignoring case and whitespace differences'
+    normalised = WHITESPACE.sub(' ', body).strip().casefold()
+    return hashlib.sha1(normalised.encode('utf-8')).digest()
+
+
+class DuplicateFilter:
+    '''Remembers which pings were sent to which channels for window seconds,
+    keeping at most max_entries of them'''
+
+    def __init__(self, window: float = DEDUPE_WINDOW,
+                 max_entries: int = MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        self.sent: typing.Dict[tuple, float] = OrderedDict()
+        self.suppressed = 0
+
+    def filter(self, body: str,
+               destinations: typing.List[dict]) -> typing.List[dict]:
+        '''Return the destinations which have not had this ping recently,
+        and remember that they now have'''
+        now = time.monotonic()
+        self.prune(now)
+
+        digest = ping_hash(body)
+        fresh = []
+        for destination in destinations:
+            key = (digest, destination['channel_id'])
+            if key in self.sent:
+                self.suppressed += 1
+                continue
+            self.sent[key] = now
+            fresh.append(destination)
+        self.prune(now)
+        return fresh
+
+    def prune(self, now: float):
+        'Forget pings older than the window and any beyond max_entries'
+        while self.sent:
+            key, sent = next(iter(self.sent.items()))
+            if now - sent < self.window and len(self.sent) <= self.max_entries:
+                break
+            del self.sent[key]
+
+    def get_health(self) -> str:
+        'Returns a string describing the duplicates suppressed'
+        return ('\n  \u2714 Deduplication: {} duplicate deliveries '
+                'suppressed, {} remembered').format(self.suppressed,
+                                                    len(self.sent))
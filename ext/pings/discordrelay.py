@@ -1,6 +1,6 @@
 from discord import Client, Status
 
-from utils.colourthief import get_embed_colour
+from utils.colourthief import DEFAULT_COLOUR, update_embed_colour
 from utils.messaging import notify_owner
 
 
@@ -8,13 +8,19 @@ class DiscordRelay:
     def __init__(self, bot, config):
         self.bot = bot
         self.config = config
-        self.config["embed_colour"] = get_embed_colour(self.config["logo_url"])
+        self.config["embed_colour"] = DEFAULT_COLOUR
+        self.colour_task = update_embed_colour(bot, config["logo_url"],
+                                               self.set_embed_colour)
         self.client = Client(loop=bot.loop)
         self.client.event(self.on_ready)
         self.client.event(self.on_message)
         bot.loop.create_task(self.client.start(config["token"], bot=False))
 
+    def set_embed_colour(self, colour):
+        self.config["embed_colour"] = colour
+
     def disconnect(self):
+        self.colour_task.cancel()
         self.bot.loop.create_task(self.client.logout())
 
     def get_health(self):
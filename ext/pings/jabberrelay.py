@@ -9,7 +9,7 @@ they are sent by a jid in the config.JABBER_SERVERS['relay_from'] list
 import aioxmpp
 from aioxmpp.structs import LanguageRange
 
-from utils.colourthief import get_embed_colour
+from utils.colourthief import DEFAULT_COLOUR, update_embed_colour
 
 
 class JabberRelay(aioxmpp.PresenceManagedClient):
@@ -37,7 +37,9 @@ class JabberRelay(aioxmpp.PresenceManagedClient):
         self.bot = bot
         self.relay_from = jabber_server['relay_from']
         self.jabber_server = jabber_server
-        self.embed_colour = get_embed_colour(jabber_server['logo_url'])
+        self.embed_colour = DEFAULT_COLOUR
+        self.colour_task = update_embed_colour(
+            bot, jabber_server['logo_url'], self.set_embed_colour)
         self.languages = [LanguageRange(tag='en'), LanguageRange.WILDCARD]
         self.summon(aioxmpp.DiscoServer)
         self.summon(aioxmpp.RosterClient)
@@ -53,7 +55,11 @@ class JabberRelay(aioxmpp.PresenceManagedClient):
 
         self.presence = aioxmpp.PresenceState(True, aioxmpp.PresenceShow.AWAY)
 
+    def set_embed_colour(self, colour):
+        self.embed_colour = colour
+
     def disconnect(self):
+        self.colour_task.cancel()
         self.presence = aioxmpp.PresenceState(False)
 
     def get_health(self):
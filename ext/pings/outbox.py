@@ -0,0 +1,108 @@
+'''
+Write-ahead outbox of pings being relayed.
+
+Each ping is appended to a JSON lines file before it is sent, followed by a
+record for every destination that receives it. Pings with destinations
+left over after a crash or restart are found again when the file is
+loaded, and the file is compacted down to them.
+'''
+import json
+import os
+import time
+import typing
+import uuid
+from collections import OrderedDict
+
+OUTBOX_PATH = 'pings.outbox'
+
+
+class PingOutbox:
+    '''Pings which have not yet reached all of their destinations, backed by
+    an append-only file'''
+
+    def __init__(self, path: str = OUTBOX_PATH):
+        self.path = path
+        self.pending: typing.Dict[str, dict] = OrderedDict()
+        self.load()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.delivered = 0
+
+    def load(self):
+        'Read the unfinished pings from disk and compact the file'
+        try:
+            with open(self.path, 'r', encoding='utf-8') as outbox:
+                for line in outbox:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # A write cut short by a crash
+                    if record['op'] == 'add':
+                        self.pending[record['id']] = record
+                    elif record['id'] in self.pending:
+                        entry = self.pending[record['id']]
+                        if record['channel_id'] in entry['remaining']:
+                            entry['remaining'].remove(record['channel_id'])
+                        if not entry['remaining']:
+                            del self.pending[record['id']]
+        except FileNotFoundError:
+            pass
+        self.compact()
+
+    def compact(self):
+        'Rewrite the file with only the unfinished pings'
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as outbox:
+            for entry in self.pending.values():
+                outbox.write(json.dumps(entry) + '\n')
+            outbox.flush()
+            os.fsync(outbox.fileno())
+        os.replace(temporary, self.path)
+
+    def write(self, record: dict):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def add(self, package: dict) -> dict:
+        '''Record a ping before sending it to the channels in its
+        destinations, returning its entry'''
+        entry = {
+            'op': 'add',
+            'id': uuid.uuid4().hex,
+            'time': time.time(),
+            'package': package,
+            'remaining': [
+                destination['channel_id']
+                for destination in package['destinations']
+            ],
+        }
+        self.write(entry)
+        self.pending[entry['id']] = entry
+        return entry
+
+    def done(self, entry: dict, channel_id: str):
+        'Record that a ping has reached one of its destinations'
+        entry['remaining'].remove(channel_id)
+        self.delivered += 1
+        if not entry['remaining']:
+            del self.pending[entry['id']]
+        if not self.pending:
+            # Nothing is left to replay, start the file again.
+            self.file.seek(0)
+            self.file.truncate()
+        else:
+            self.write({'op': 'done', 'id': entry['id'],
+                        'channel_id': channel_id})
+
+    def close(self):
+        self.file.close()
+
+    def get_health(self) -> str:
+        'Returns a string describing the undelivered pings'
+        if not self.pending:
+            return '\n  \u2714 Outbox: empty, {} deliveries'.format(
+                self.delivered)
+        oldest = time.time() - next(iter(self.pending.values()))['time']
+        return ('\n  \u2716 Outbox: {} pings undelivered, oldest {:.0f}s, '
+                '{} deliveries').format(len(self.pending), oldest,
+                                        self.delivered)
@@ -1,39 +1,124 @@
-from urllib.request import urlopen
+'''
+Embed colours picked from logos.
 
+Logos are downloaded without blocking the event loop and their colour is
+extracted in a worker process. Results are cached in TinyDB by URL and
+revalidated with the logo's ETag.
+'''
+import asyncio
+import io
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
 from colorthief import ColorThief as ColourThief
 from colorthief import MMCQ
 from discord import Colour
+from discord.ext import commands
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils.kvtable import KeyValueTable
+from utils.log import get_logger
+
+DEFAULT_COLOUR = Colour.default()
+CACHE_TABLE = 'colourthief.cache'
+FETCH_TIMEOUT = 30
+WORKERS = 1
+
+_executor: ProcessPoolExecutor = None
+_saturated: bytes = None
+
+
+def extract_colour(image: bytes) -> int:
+    'Return the most prominent saturated colour of an image as an integer'
+    return SaturatedColourThief(io.BytesIO(image)).get_color(1).value
+
+
+async def get_embed_colour(bot: commands.Bot, url: str) -> Colour:
+    '''Return the colour of the logo at url, reusing the cached colour if
+    the logo is unchanged or cannot be fetched'''
+    global _executor
+    cache = KeyValueTable(bot.tdb, CACHE_TABLE)
+    cached = cache.get(url)
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+
+    try:
+        with aiohttp.Timeout(FETCH_TIMEOUT):
+            async with bot.http.session.get(url, headers=headers) as resp:
+                if resp.status == 304:
+                    return Colour(cached['colour'])
+                resp.raise_for_status()
+                image = await resp.read()
+                etag = resp.headers.get('ETag')
+    except (aiohttp.errors.ClientError, aiohttp.errors.HttpProcessingError,
+            asyncio.TimeoutError):
+        if cached:
+            return Colour(cached['colour'])
+        raise
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(WORKERS)
+    colour = await bot.loop.run_in_executor(_executor, extract_colour, image)
+    cache[url] = {'etag': etag, 'colour': colour}
+    return Colour(colour)
+
 
+def update_embed_colour(bot: commands.Bot, url: str,
+                        callback: typing.Callable) -> asyncio.Task:
+    '''Find the colour of the logo at url in the background and pass it to
+    callback once known'''
+    logger = get_logger(__name__, bot)
 
-def get_embed_colour(url):
-    colour_thief = SaturatedColourThief(
-        urlopen(url)
-    )
-    return colour_thief.get_color(1)
+    async def update():
+        try:
+            callback(await get_embed_colour(bot, url))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.warning('Failed to get embed colour of %s', url,
+                           exc_info=True)
+
+    return bot.loop.create_task(update())
+
+
+def is_saturated(max_channel: int, min_channel: int) -> bool:
+    '''Whether a pixel with the given largest and smallest channels is
+    neither very dark, very light nor greyscale'''
+    max_rgb = max_channel / 255.0
+    min_rgb = min_channel / 255.0
+    lightness = 0.5 * (max_rgb + min_rgb)
+    if lightness <= 0.1 or lightness > 0.9:
+        return False  # Skip very dark/light pixels
+    if lightness <= 0.5:
+        saturation = (max_rgb - min_rgb) / (2 * lightness)
+    else:
+        saturation = (max_rgb - min_rgb) / (2 - 2 * lightness)
+    return saturation > 0.4  # Skip 'greyscale' pixels
+
+
+def saturated_table() -> bytes:
+    '''is_saturated for every pair of channels, indexed by
+    max_channel << 8 | min_channel'''
+    global _saturated
+    if _saturated is None:
+        _saturated = bytes(
+            is_saturated(index >> 8, index & 0xff) for index in range(65536))
+    return _saturated
 
 
 class SaturatedColourThief(ColourThief):
     def get_palette(self, color_count=10, quality=10):
         image = self.image.convert('RGBA')
-        pixels = image.getdata()
-        pixel_count = image.size[0] * image.size[1]
-        valid_pixels = []
-        for i in range(0, pixel_count, quality):
-            # red, green, blue, alpha = pixels[i]
-
-            if pixels[i][3] < 125:  # Skip pixels with low alpha
-                continue
-            max_rgb = max(pixels[i][:3]) / 255.0
-            min_rgb = min(pixels[i][:3]) / 255.0
-            lightness = 0.5 * (max_rgb + min_rgb)
-            if lightness <= 0.1 or lightness > 0.9:
-                continue  # Skip very dark/light pixels
-            if lightness <= 0.5:
-                saturation = (max_rgb - min_rgb) / (2 * lightness)
-            else:
-                saturation = (max_rgb - min_rgb) / (2 - 2 * lightness)
-            if saturation > 0.4:  # Skip 'greyscale' pixels
-                valid_pixels.append(pixels[i][:3])
+        if numpy is not None:
+            valid_pixels = self.saturated_pixels_numpy(image, quality)
+        else:
+            valid_pixels = self.saturated_pixels(image, quality)
 
         if not valid_pixels:  # Fall back to original method.
             palette = super(SaturatedColourThief, self).get_palette(
@@ -46,6 +131,32 @@ class SaturatedColourThief(ColourThief):
         cmap = MMCQ.quantize(valid_pixels, color_count)
         return cmap.palette
 
+    @staticmethod
+    def saturated_pixels(image, quality: int) -> list:
+        '''Every quality-th pixel of an RGBA image which is opaque and
+        saturated, as RGB tuples'''
+        table = saturated_table()
+        data = image.tobytes()
+        valid_pixels = []
+        for i in range(0, len(data), 4 * quality):
+            if data[i + 3] < 125:  # Skip pixels with low alpha
+                continue
+            pixel = data[i], data[i + 1], data[i + 2]
+            if table[max(pixel) << 8 | min(pixel)]:
+                valid_pixels.append(pixel)
+        return valid_pixels
+
+    @staticmethod
+    def saturated_pixels_numpy(image, quality: int) -> list:
+        'saturated_pixels with the filtering done on whole arrays'
+        table = numpy.frombuffer(saturated_table(), dtype=numpy.bool_)
+        pixels = numpy.frombuffer(image.tobytes(), dtype=numpy.uint8)
+        pixels = pixels.reshape(-1, 4)[::quality]
+        rgb = pixels[:, :3]
+        index = rgb.max(axis=1).astype(numpy.uint16) << 8 | rgb.min(axis=1)
+        valid = (pixels[:, 3] >= 125) & table[index]
+        return [tuple(pixel) for pixel in rgb[valid].tolist()]
+
     def get_color(self, quality):
         colour = super(SaturatedColourThief, self).get_color(quality)
         return Colour((colour[0] << 16) + (colour[1] << 8) + colour[2])
@@ -0,0 +1,134 @@
+'''
+Expiry aware cache for ESI responses.
+
+Recently used responses are kept in memory, and every cached response is
+also written to an SQLite database so that it survives restarts. Writes are
+committed together a few seconds after the first of them, rather than one
+fsync per response on the event loop.
+'''
+import asyncio
+import json
+import sqlite3
+import time
+import typing
+from collections import OrderedDict, namedtuple
+from email.utils import parsedate_to_datetime
+
+DEFAULT_MAX_ENTRIES = 4096
+PRUNE_AFTER = 7 * 24 * 3600
+COMMIT_DELAY = 5
+
+
+class CacheEntry(namedtuple('CacheEntry', ['expires', 'headers', 'body'])):
+    'A cached ESI response and the time it stops being fresh'
+    __slots__ = ()
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires > time.time()
+
+    @property
+    def etag(self) -> str:
+        return self.headers.get('etag')
+
+
+def make_cache_key(method: str, url: str, query: typing.Iterable,
+                   data=None) -> str:
+    'Build a key identifying a request by its method, url and parameters'
+    params = '&'.join('{}={}'.format(*pair) for pair in sorted(query))
+    key = '{} {}?{}'.format(method.upper(), url, params)
+    if data:
+        key += ' ' + str(data)
+    return key
+
+
+def parse_expires(headers: dict) -> float:
+    'Return the Expires header as a timestamp, or now if missing or invalid'
+    try:
+        return parsedate_to_datetime(headers['expires']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+class EsiCache:
+    '''Bounded in-memory LRU in front of a persistent SQLite store'''
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: typing.Dict[str, CacheEntry] = OrderedDict()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.commit_handle: asyncio.Handle = None
+
+        self.database = sqlite3.connect(path)
+        self.database.execute('PRAGMA journal_mode=WAL')
+        self.database.execute('PRAGMA synchronous=NORMAL')
+        self.database.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, expires REAL, headers TEXT, body BLOB)')
+        self.database.execute('DELETE FROM responses WHERE expires < ?',
+                              (time.time() - PRUNE_AFTER, ))
+        self.database.commit()
+
+    def get(self, key: str) -> CacheEntry:
+        'Return the entry for key from memory or disk, or None'
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+
+        row = self.database.execute(
+            'SELECT expires, headers, body FROM responses WHERE key = ?',
+            (key, )).fetchone()
+        if row is None:
+            return None
+
+        entry = CacheEntry(row[0], json.loads(row[1]), row[2])
+        self._remember(key, entry)
+        return entry
+
+    def set(self, key: str, headers: dict, body: bytes) -> CacheEntry:
+        'Store a response, returning the new entry'
+        headers = {name.lower(): value for name, value in headers.items()}
+        entry = CacheEntry(parse_expires(headers), headers, body)
+        self._remember(key, entry)
+        self.database.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+            (key, entry.expires, json.dumps(headers), body))
+        if self.commit_handle is None:
+            self.commit_handle = asyncio.get_event_loop().call_later(
+                COMMIT_DELAY, self.commit)
+        return entry
+
+    def commit(self):
+        'Commit the responses stored since the last commit'
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        self.database.commit()
+
+    def close(self):
+        self.commit()
+        self.database.close()
+
+    def refresh(self, key: str, entry: CacheEntry,
+                headers: dict) -> CacheEntry:
+        'Extend the life of entry after a 304 Not Modified response'
+        merged = dict(entry.headers)
+        merged.update(
+            (name.lower(), value) for name, value in headers.items())
+        self.revalidations += 1
+        return self.set(key, merged, entry.body)
+
+    def _remember(self, key: str, entry: CacheEntry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_health(self) -> str:
+        'Returns a string describing the effectiveness of the cache'
+        return ('\n  \u2714 ESI cache: {} hits, {} revalidated, {} misses '
+                '({} in memory)').format(self.hits, self.revalidations,
+                                          self.misses, len(self.entries))
@@ -1,34 +1,240 @@
 import asyncio
+import os
+import pickle
+import time
+import typing
 
+import aiohttp
 import esipy
 from discord.ext import commands
-from requests.adapters import DEFAULT_POOLSIZE
 
+from utils.esicache import EsiCache, make_cache_key
+from utils.esischeduler import PRIORITY_HIGH, EsiScheduler
 from utils.log import get_logger
 
 ESI_SWAGGER_JSON = 'https://esi.evetech.net/dev/swagger.json'
+ESI_CACHE_PATH = 'esicache.sqlite3'
+ESI_SWAGGER_PATH = 'esiswagger.json'
+ESI_APP_PATH = 'esiapp.pickle'
+ESI_RETRIES = 3
+ESI_TIMEOUT = 30
+ESI_KEEPALIVE = 30
+DEFAULT_POOL_SIZE = 20
+USER_AGENT = 'antinub-gregbot'
 
 
 class EsiCog:
+    _esi_app: esipy.App = None
     _esi_app_task: asyncio.Task = None
-    _semaphore = asyncio.Semaphore(DEFAULT_POOLSIZE)
+    _esi_app_load_time: float = None
+    _esi_app_first_wait: float = None
+    _esi_app_wait_start: float = None
+    _session: aiohttp.ClientSession = None
+    _scheduler: EsiScheduler = None
+    _cache: EsiCache = None
+    _in_flight: typing.Dict[str, asyncio.Future] = {}
+    _coalesced = 0
 
     def __init__(self, bot: commands.Bot):
         logger = get_logger(__name__, bot)
 
+        if EsiCog._cache is None:
+            EsiCog._cache = EsiCache(ESI_CACHE_PATH)
+
+        if EsiCog._session is None:
+            pool_size = bot.config.get("esi_pool_size", DEFAULT_POOL_SIZE)
+            connector = aiohttp.TCPConnector(
+                limit=pool_size, keepalive_timeout=ESI_KEEPALIVE,
+                loop=bot.loop)
+            EsiCog._session = aiohttp.ClientSession(
+                connector=connector, headers={"User-Agent": USER_AGENT},
+                loop=bot.loop)
+            EsiCog._scheduler = EsiScheduler(pool_size)
+
         if EsiCog._esi_app_task is None:
+            EsiCog._esi_app_task = bot.loop.create_task(
+                self._load_esi_app(logger))
+
+    async def get_esi_app(self) -> esipy.App:
+        if EsiCog._esi_app is None:
+            await asyncio.shield(self._esi_app_task)
+        return EsiCog._esi_app
+
+    def measure_esi_app_wait(self):
+        '''Time from now until the esipy App is loaded, for the health check,
+        unless this has already been done. Called as the first killmail
+        arrives.'''
+        if EsiCog._esi_app_wait_start is not None:
+            return
+        start = EsiCog._esi_app_wait_start = time.monotonic()
+        if EsiCog._esi_app is not None:
+            EsiCog._esi_app_first_wait = 0.0
+            return
+
+        def loaded(task: asyncio.Task):
+            if EsiCog._esi_app is not None:
+                EsiCog._esi_app_first_wait = time.monotonic() - start
+
+        EsiCog._esi_app_task.add_done_callback(loaded)
+
+    async def _load_esi_app(self, logger):
+        '''Load the esipy App from disk, falling back to fetching the swagger
+        spec, then check for a newer spec in the background.'''
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+
+        app = await loop.run_in_executor(None, self._unpickle_esi_app)
+        if app is None:
             logger.info("Creating esipy App...")
-            EsiCog._esi_app_task = bot.loop.run_in_executor(
-                None, self._create_esi_app)
-            EsiCog._esi_app_task.add_done_callback(
-                lambda f: logger.info("esipy App created"))
+            await self._fetch_swagger()
+            app = await loop.run_in_executor(None, self._create_esi_app,
+                                             logger)
+        EsiCog._esi_app = app
+        EsiCog._esi_app_load_time = time.monotonic() - start
+        logger.info("esipy App loaded in %.2fs", EsiCog._esi_app_load_time)
+        loop.create_task(self._revalidate_esi_app(logger))
+
+    async def _revalidate_esi_app(self, logger):
+        loop = asyncio.get_event_loop()
+        try:
+            if await self._fetch_swagger():
+                logger.info("ESI swagger spec changed, recreating esipy App")
+                EsiCog._esi_app = await loop.run_in_executor(
+                    None, self._create_esi_app, logger)
+        except (aiohttp.errors.ClientError, asyncio.TimeoutError) as exc:
+            logger.warning("Failed to revalidate ESI swagger spec: %s", exc)
+
+    async def _fetch_swagger(self) -> bool:
+        '''Download the swagger spec if it has changed since it was last
+        saved, returning whether it was updated.'''
+        key = make_cache_key("GET", ESI_SWAGGER_JSON, ())
+        entry = self._cache.get(key)
+        headers = {}
+        if entry is not None and entry.etag and os.path.exists(
+                ESI_SWAGGER_PATH):
+            headers["If-None-Match"] = entry.etag
+
+        status, response_headers, body = await self._send(
+            "GET", ESI_SWAGGER_JSON, (), None, headers)
+        if status == 304:
+            self._cache.refresh(key, entry, response_headers)
+            return False
+        if status != 200:
+            raise aiohttp.errors.HttpProcessingError(
+                code=status, message="Failed to fetch ESI swagger spec")
+
+        with open(ESI_SWAGGER_PATH, "wb") as swagger_file:
+            swagger_file.write(body)
+        self._cache.set(key, response_headers, b"")
+        return True
+
+    def _create_esi_app(self, logger) -> esipy.App:
+        app = esipy.App.create(url=os.path.abspath(ESI_SWAGGER_PATH))
+        temporary = ESI_APP_PATH + ".tmp"
+        try:
+            with open(temporary, "wb") as app_file:
+                pickle.dump(app, app_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, ESI_APP_PATH)
+        except Exception:
+            # The App still works, it is just created again next start.
+            logger.warning("Failed to save esipy App", exc_info=True)
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+        return app
+
+    def _unpickle_esi_app(self) -> esipy.App:
+        try:
+            with open(ESI_APP_PATH, "rb") as app_file:
+                return pickle.load(app_file)
+        except (OSError, pickle.UnpicklingError, AttributeError,
+                EOFError, ImportError):
+            return None
+
+    def get_esi_health(self) -> str:
+        'Returns a string describing the state of the shared ESI client'
+        if EsiCog._esi_app_load_time is None:
+            response = '\n  \u2716 esipy App not yet loaded'
+        else:
+            response = '\n  \u2714 esipy App loaded in {:.2f}s'.format(
+                EsiCog._esi_app_load_time)
+            if EsiCog._esi_app_first_wait is not None:
+                response += ', first killmail waited {:.2f}s'.format(
+                    EsiCog._esi_app_first_wait)
+        requests = '\n  \u2714 ESI requests: {} in flight, {} coalesced'
+        requests = requests.format(len(EsiCog._in_flight), EsiCog._coalesced)
+        return (response + self._cache.get_health() + requests +
+                self._scheduler.get_health())
+
+    async def esi_request(self, operation, priority: int = PRIORITY_HIGH):
+        '''Perform an esipy operation, answering from the cache when possible.
+
+        GET responses are cached until their Expires time and revalidated
+        with their ETag afterwards. Concurrent identical requests share a
+        single round-trip. Requests are scheduled in order of priority, see
+        utils.esischeduler.
+        '''
+        request, response = operation
+        request.prepare(scheme="https", handle_files=False)
+        cacheable = request.method.upper() == "GET"
+
+        key = make_cache_key(request.method, request.url, request.query,
+                             request.data)
+        entry = self._cache.get(key) if cacheable else None
+        if entry is not None and entry.fresh:
+            self._cache.hits += 1
+            response.apply_with(status=200, raw=entry.body,
+                                header=entry.headers)
+            return response
+
+        pending = EsiCog._in_flight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self._fetch(key, request, entry, priority))
+            pending.add_done_callback(
+                lambda f: EsiCog._in_flight.pop(key, None))
+            EsiCog._in_flight[key] = pending
+        else:
+            EsiCog._coalesced += 1
+
+        status, response_headers, body = await asyncio.shield(pending)
+        response.apply_with(status=status, raw=body, header=response_headers)
+        return response
+
+    async def _fetch(self, key: str, request, entry, priority: int) -> tuple:
+        cacheable = request.method.upper() == "GET"
+        headers = dict(request.header)
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+
+        status, response_headers, body = await self._send(
+            request.method, request.url, request.query, request.data, headers,
+            priority)
 
-    async def get_esi_app(self) -> asyncio.Task:
-        return await self._esi_app_task
+        if status == 304 and entry is not None:
+            entry = self._cache.refresh(key, entry, response_headers)
+            return 200, entry.headers, entry.body
 
-    def _create_esi_app(self):
-        return esipy.App.create(url=ESI_SWAGGER_JSON)
+        if cacheable:
+            self._cache.misses += 1
+            if status == 200:
+                self._cache.set(key, response_headers, body)
+        return status, response_headers, body
 
-    async def esi_request(self, loop, client, operation):
-        async with self._semaphore:
-            return await loop.run_in_executor(None, client.request, operation)
+    async def _send(self, method: str, url: str, params, data, headers: dict,
+                    priority: int = PRIORITY_HIGH) -> tuple:
+        for _ in range(ESI_RETRIES):
+            await self._scheduler.acquire(priority)
+            try:
+                with aiohttp.Timeout(ESI_TIMEOUT):
+                    async with self._session.request(
+                            method.upper(), url, params=params, data=data,
+                            headers=headers) as result:
+                        body = await result.read()
+                self._scheduler.update(result.status, result.headers)
+            finally:
+                self._scheduler.release()
+            if result.status < 500:
+                break
+        return result.status, dict(result.headers), body
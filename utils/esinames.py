@@ -0,0 +1,91 @@
+'''
+Batched resolution of EVE entity names through ESI's /universe/names/.
+
+IDs requested within a short window of each other are resolved together
+with a single POST, and recently resolved names are kept in memory.
+'''
+import asyncio
+import typing
+from collections import OrderedDict
+
+BATCH_WINDOW = 0.05
+BATCH_SIZE = 1000
+DEFAULT_MAX_NAMES = 10000
+
+
+class NameResolver:
+    '''Collects IDs from concurrent callers and resolves them in bulk'''
+
+    def __init__(self, get_esi_app: typing.Callable,
+                 esi_request: typing.Callable, logger,
+                 window: float = BATCH_WINDOW,
+                 max_names: int = DEFAULT_MAX_NAMES):
+        self.get_esi_app = get_esi_app
+        self.esi_request = esi_request
+        self.logger = logger
+        self.window = window
+        self.max_names = max_names
+
+        self.names: typing.Dict[int, str] = OrderedDict()
+        self.batch: typing.Dict[int, asyncio.Future] = {}
+        self.flush_handle: asyncio.Handle = None
+        self.hits = 0
+        self.batches = 0
+        self.resolved = 0
+
+    async def resolve(self, entity_id: int) -> str:
+        'Return the name of entity_id, or None if it could not be resolved'
+        if entity_id in self.names:
+            self.hits += 1
+            self.names.move_to_end(entity_id)
+            return self.names[entity_id]
+
+        future = self.batch.get(entity_id)
+        if future is None:
+            future = asyncio.Future()
+            self.batch[entity_id] = future
+            if self.flush_handle is None:
+                loop = asyncio.get_event_loop()
+                self.flush_handle = loop.call_later(
+                    self.window, lambda: loop.create_task(self.flush()))
+        return await asyncio.shield(future)
+
+    async def flush(self):
+        'Resolve every ID collected since the last flush'
+        batch, self.batch = self.batch, {}
+        self.flush_handle = None
+        ids = list(batch)
+        try:
+            esi_app = await self.get_esi_app()
+            for start in range(0, len(ids), BATCH_SIZE):
+                operation = esi_app.op["post_universe_names"](
+                    ids=ids[start:start + BATCH_SIZE])
+                response = await self.esi_request(operation)
+                self.batches += 1
+                if response.status != 200:
+                    # One invalid ID fails the whole request, callers fall
+                    # back to looking up entities individually.
+                    self.logger.debug("Failed to resolve names: %s %s",
+                                      response.status, response.data)
+                    continue
+                for entity in response.data:
+                    self.remember(entity["id"], entity["name"])
+        except Exception:
+            self.logger.exception("Failed to resolve names")
+        finally:
+            for entity_id, future in batch.items():
+                if not future.done():
+                    future.set_result(self.names.get(entity_id))
+
+    def remember(self, entity_id: int, name: str):
+        self.resolved += 1
+        self.names[entity_id] = name
+        self.names.move_to_end(entity_id)
+        while len(self.names) > self.max_names:
+            self.names.popitem(last=False)
+
+    def get_health(self) -> str:
+        'Returns a string describing the state of the resolver'
+        return ('\n  \u2714 Names: {} resolved in {} batches, {} cache hits '
+                '({} cached)').format(self.resolved, self.batches, self.hits,
+                                      len(self.names))
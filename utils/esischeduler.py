@@ -0,0 +1,129 @@
+'''
+Scheduling of ESI requests around ESI's error limit.
+
+ESI bans clients that make too many erroneous requests within a window, and
+reports the remaining budget in X-Esi-Error-Limit-Remain/-Reset headers.
+Requests are slowed down as the budget runs out and paused when it is
+nearly gone. Slots are only handed out when the budget allows a request,
+so waiting requests are let through in order of priority rather than
+holding slots through a pause.
+'''
+import asyncio
+import heapq
+import itertools
+import time
+import typing
+from collections import deque
+
+PRIORITY_HIGH = 0
+PRIORITY_BACKGROUND = 1
+
+ERROR_LIMIT_SLOW = 50
+ERROR_LIMIT_PAUSE = 5
+ERROR_LIMIT_WINDOW = 60  # Pause after a 420 which gives no reset time
+WAIT_SAMPLES = 100
+
+
+class EsiScheduler:
+    '''Grants a bounded number of concurrent request slots, highest
+    priority first, while respecting the ESI error limit'''
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.active = 0
+        self.waiting: typing.List[tuple] = []
+        self.counter = itertools.count()
+
+        self.error_limit_remain: int = None
+        self.error_limit_reset: float = 0
+        self.not_before = 0.0
+        self.grant_handle: asyncio.Handle = None
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    async def acquire(self, priority: int = PRIORITY_HIGH):
+        'Wait for a request slot and for the error limit to allow a request'
+        start = time.monotonic()
+        if (self.active < self.concurrency and not self.waiting
+                and self.delay() <= 0):
+            self.active += 1
+        else:
+            future = asyncio.Future()
+            heapq.heappush(self.waiting,
+                           (priority, next(self.counter), future))
+            self.grant()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()  # The slot was handed over already
+                raise
+        self.waits.append(time.monotonic() - start)
+
+    def release(self):
+        'Free a slot and hand it on if a waiting request may go'
+        self.active -= 1
+        self.grant()
+
+    def grant(self):
+        '''Hand free slots to the highest priority waiting requests as fast
+        as the error budget allows, scheduling another try if it does not'''
+        if self.grant_handle is not None:
+            self.grant_handle.cancel()
+            self.grant_handle = None
+        while self.waiting and self.active < self.concurrency:
+            now = time.monotonic()
+            delay = self.delay()
+            if delay > 0 and self.error_limit_remain <= ERROR_LIMIT_PAUSE:
+                wait = delay
+            else:
+                wait = self.not_before - now
+            if wait > 0:
+                self.grant_handle = asyncio.get_event_loop().call_later(
+                    wait, self.grant)
+                return
+
+            _, _, future = heapq.heappop(self.waiting)
+            if future.done():  # Cancelled while waiting
+                continue
+            self.active += 1
+            future.set_result(None)
+            if delay > 0:  # Space requests out while the budget is low
+                self.not_before = now + delay
+
+    def delay(self) -> float:
+        'Seconds to wait before the next request given the error budget'
+        remaining = self.error_limit_reset - time.monotonic()
+        if self.error_limit_remain is None or remaining <= 0:
+            return 0
+        if self.error_limit_remain <= ERROR_LIMIT_PAUSE:
+            return remaining
+        if self.error_limit_remain <= ERROR_LIMIT_SLOW:
+            return remaining / self.error_limit_remain
+        return 0
+
+    def update(self, status: int, headers: dict):
+        'Record the error limit reported with a response'
+        try:
+            self.error_limit_remain = int(headers['X-Esi-Error-Limit-Remain'])
+            self.error_limit_reset = time.monotonic() + int(
+                headers['X-Esi-Error-Limit-Reset'])
+        except (KeyError, ValueError):
+            pass
+        if status == 420:  # Error limited, nothing will succeed until reset
+            self.error_limit_remain = 0
+            if self.error_limit_reset <= time.monotonic():
+                self.error_limit_reset = (time.monotonic() +
+                                          ERROR_LIMIT_WINDOW)
+
+    def get_health(self) -> str:
+        'Returns a string describing the queue and error budget'
+        mean_wait = sum(self.waits) / len(self.waits) if self.waits else 0
+        if self.delay() > 0:
+            response = '\n  \u2716 ESI scheduler: throttled, {} errors left'
+        else:
+            response = '\n  \u2714 ESI scheduler: {} errors left'
+        response += ', {} queued, {} active, mean wait {:.0f}ms'
+        return response.format(
+            '?' if self.error_limit_remain is None else
+            self.error_limit_remain, len(self.waiting), self.active,
+            1000 * mean_wait)
@@ -0,0 +1,233 @@
+'''
+Compact, memory-mapped index of EVE static data.
+
+Compile the index from the CSV export of the static data (e.g. the Fuzzwork
+SDE conversion) with:
+
+    python -m utils.staticdata path/to/sde/csv staticdata.bin
+
+Every table is stored as sorted columns of native int32, followed by a blob
+of UTF-8 names, so lookups are a binary search over the mapped file.
+'''
+import csv
+import mmap
+import os
+import struct
+import sys
+import typing
+from array import array
+from bisect import bisect_left
+
+MAGIC = b'GSDE'
+VERSION = 1
+HEADER = struct.Struct('=4sIIIII')
+INT = struct.Struct('=i')
+RIG_SLOTS_ATTRIBUTE = 1137
+
+# Column names of each table, in the order they are written to the file.
+TABLES = (
+    ('systems', ('system_id', 'constellation_id', 'region_id')),
+    ('constellations', ('constellation_id', 'region_id')),
+    ('regions', ('region_id', )),
+    ('types', ('type_id', 'rig_slots')),
+)
+
+
+class Table:
+    '''A view of one table's columns within the mapped file'''
+
+    def __init__(self, columns: typing.Dict[str, memoryview], names):
+        self.columns = columns
+        self.keys = next(iter(columns.values()))
+        self.names = names
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key: int) -> dict:
+        'Return the row with the given ID as a dict, or None'
+        index = bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+        row = {
+            name: column[index]
+            for name, column in self.columns.items()
+            if not name.startswith('name_')
+        }
+        start = self.columns['name_offset'][index]
+        stop = start + self.columns['name_length'][index]
+        row['name'] = bytes(self.names[start:stop]).decode('utf-8')
+        return row
+
+
+class StaticData:
+    '''Read-only lookups of systems, constellations, regions and types'''
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        try:
+            self.map = self.map_index(path)
+        except Exception:
+            self.file.close()
+            raise
+        self.view = view = memoryview(self.map)
+
+        _, _, *counts = HEADER.unpack_from(self.map)
+        offset = HEADER.size
+        tables = {}
+        for (name, fields), count in zip(TABLES, counts):
+            columns = {}
+            for field in fields + ('name_offset', 'name_length'):
+                size = count * 4
+                columns[field] = view[offset:offset + size].cast('i')
+                offset += size
+            tables[name] = columns
+        names = view[offset:]
+
+        self.systems = Table(tables['systems'], names)
+        self.constellations = Table(tables['constellations'], names)
+        self.regions = Table(tables['regions'], names)
+        self.types = Table(tables['types'], names)
+
+    def map_index(self, path: str) -> mmap.mmap:
+        '''Map the open file, raising ValueError unless its header is valid
+        and its size matches the counts in the header'''
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError('{} is not a static data index'.format(path))
+        index_map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, *counts = HEADER.unpack_from(index_map)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(
+                    '{} is not a static data index'.format(path))
+            expected = HEADER.size + sum(
+                4 * count * (len(fields) + 2)
+                for (_, fields), count in zip(TABLES, counts))
+            if size < expected:
+                raise ValueError('{} is truncated'.format(path))
+            expected += names_size(index_map, counts)
+            if size != expected:
+                raise ValueError('{} is {} bytes, expected {}'.format(
+                    path, size, expected))
+        except Exception:
+            index_map.close()
+            raise
+        return index_map
+
+    def close(self):
+        'Release the mapped file'
+        for table in (self.systems, self.constellations, self.regions,
+                      self.types):
+            for column in table.columns.values():
+                column.release()
+            table.names.release()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def system(self, system_id: int) -> dict:
+        return self.systems.get(system_id)
+
+    def constellation(self, constellation_id: int) -> dict:
+        return self.constellations.get(constellation_id)
+
+    def region(self, region_id: int) -> dict:
+        return self.regions.get(region_id)
+
+    def ship_type(self, type_id: int) -> dict:
+        'Return the type shaped like an ESI response, or None'
+        row = self.types.get(type_id)
+        if row is None:
+            return None
+        row['dogma_attributes'] = [{
+            'attribute_id': RIG_SLOTS_ATTRIBUTE,
+            'value': row.pop('rig_slots')
+        }]
+        return row
+
+    def rig_slots(self, type_id: int) -> int:
+        'Return the number of rig slots of type_id, or None if unknown'
+        row = self.types.get(type_id)
+        return None if row is None else row['rig_slots']
+
+
+def names_size(index_map: mmap.mmap, counts: typing.List[int]) -> int:
+    '''The length of the names blob, which ends with the name of the last
+    row of the last table with any rows'''
+    offset = HEADER.size
+    end = 0
+    for (_, fields), count in zip(TABLES, counts):
+        if count:
+            name_offset = offset + 4 * count * len(fields)
+            last = 4 * (count - 1)
+            start, = INT.unpack_from(index_map, name_offset + last)
+            length, = INT.unpack_from(index_map,
+                                      name_offset + 4 * count + last)
+            end = start + length
+        offset += 4 * count * (len(fields) + 2)
+    return end
+
+
+def read_csv(directory: str, name: str) -> typing.Iterator[dict]:
+    with open(os.path.join(directory, name), newline='',
+              encoding='utf-8') as csv_file:
+        yield from csv.DictReader(csv_file)
+
+
+def compile_index(directory: str, path: str):
+    'Compile the SDE CSV files in directory into an index at path'
+    rig_slots = {}
+    for row in read_csv(directory, 'dgmTypeAttributes.csv'):
+        if int(row['attributeID']) == RIG_SLOTS_ATTRIBUTE:
+            value = row['valueInt'] or row['valueFloat']
+            rig_slots[int(row['typeID'])] = int(float(value))
+
+    sources = {
+        'systems': (
+            (int(row['solarSystemID']), int(row['constellationID']),
+             int(row['regionID']), row['solarSystemName'])
+            for row in read_csv(directory, 'mapSolarSystems.csv')),
+        'constellations': (
+            (int(row['constellationID']), int(row['regionID']),
+             row['constellationName'])
+            for row in read_csv(directory, 'mapConstellations.csv')),
+        'regions': (
+            (int(row['regionID']), row['regionName'])
+            for row in read_csv(directory, 'mapRegions.csv')),
+        'types': (
+            (int(row['typeID']), rig_slots.get(int(row['typeID']), 0),
+             row['typeName'])
+            for row in read_csv(directory, 'invTypes.csv')),
+    }
+
+    names = bytearray()
+    counts = []
+    columns = []
+    for name, fields in TABLES:
+        rows = sorted(sources[name])
+        counts.append(len(rows))
+        table = [array('i') for _ in range(len(fields) + 2)]
+        for row in rows:
+            encoded = row[-1].encode('utf-8')
+            for column, value in zip(table, row[:-1] +
+                                     (len(names), len(encoded))):
+                column.append(value)
+            names += encoded
+        columns.extend(table)
+
+    # Written aside and renamed, so an interrupted compile leaves any
+    # previous index in place.
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, VERSION, *counts))
+        for column in columns:
+            column.tofile(index_file)
+        index_file.write(names)
+    os.replace(temporary, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('Usage: python -m utils.staticdata <sde csv dir> <output>')
+    compile_index(*sys.argv[1:])